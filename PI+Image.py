@@ -1,37 +1,49 @@
 import openai
 import pandas as pd
 import os
-import time
-import json
-import re
+
+from pipeline.adaptive import AdaptiveSampling
+from pipeline.backends import model_outputs
+from pipeline.cache import ResponseCache
+from pipeline.dataset import load_dataset
+from pipeline.dead_letter import DeadLetterStore
+from pipeline.dispatch import fan_out, make_jobs, run_jobs
+from pipeline.hedging import HedgingPolicy
+from pipeline.images import DirectoryUploader, ImagePreprocessor, ImageRegistry, image_content
+from pipeline.journal import Journal, check_existing_outputs
+from pipeline.output import PartitionedOutput
+from pipeline.planner import TokenPlanner, output_token_history
+from pipeline.prompts import PromptTemplate
+from pipeline.rate_limit import RateLimiter
+from pipeline.schemas import diagnosis_schema
+from pipeline.sharding import merge_shard_journals, shard_jobs, shard_path
+from pipeline.store import export_result_store
 
 # Load the Excel file that contains the file names and URLs
 file_path = "###"
 
-with open("###", "r", encoding="utf-8") as f:
-    case_image_links = json.load(f)
+# The workbook is converted once to a Parquet copy in dataset_cache_dir (rebuilt whenever the
+# file changes) and only the columns used below are loaded from it
+dataset_cache_dir = "dataset_cache"
 
 # Read the Excel file
-df = pd.read_excel(file_path)
+df = load_dataset(file_path, ['Case_No', 'Sex', 'Age', 'Chief Complaint', 'Diagnosis'],
+                  optional_columns=['Legend'], cache_dir=dataset_cache_dir, image_links_path="###")
 case_no_list = df['Case_No'].tolist()
 sex_list = df['Sex'].tolist()
 age_list = df['Age'].tolist()
 complaint_list = df['Chief Complaint'].tolist()
 legend_list = df['Legend'].tolist() if 'Legend' in df.columns else [""] * len(df)
 true_diag_list = df['Diagnosis'].tolist()
+image_links_list = df['Image Links'].tolist()
 
 openai.api_key = "###"
 
-def generate_prompt(sex, age, complaint, legend=None):
-    complaint = str(complaint).strip() if complaint and not pd.isna(complaint) else "Not available"
-
-    legend_text = ""
-    if legend and not pd.isna(legend) and str(legend).strip():
-        legend_text = f"\n### Image Legend\n{str(legend).strip()}"
-    else:
-        legend_text = "\n### Image Legend\nNot available"
-
-    message_p = f"""
+# Prompt text of this condition; the patient information section is filled in per case.
+# prompt_layout "original" sends it exactly as written, "compact" strips the indentation and moves
+# the static instructions and JSON example ahead of the patient information, so every request
+# shares the same prefix and the provider can serve it from its prompt cache
+prompt_template = PromptTemplate("""
     You are an experienced thoracic radiologist.
     This is a quiz case designed for radiology specialists.
     
@@ -56,7 +68,7 @@ def generate_prompt(sex, age, complaint, legend=None):
     ### Patient Information
     - Sex: {sex}
     - Age: {age}
-    - Chief complaint: {complaint.strip()}{legend_text}
+    - Chief complaint: {complaint}{legend_text}
         
     Provide the result as a JSON object structured as follows:
     {{
@@ -72,140 +84,300 @@ def generate_prompt(sex, age, complaint, legend=None):
       ],
     }}
     Only include meaningful and specific diagnoses.
-    """
+    """)
+prompt_layout = "original"
 
-    return message_p
+def generate_prompt(sex, age, complaint, legend=None):
+    complaint = str(complaint).strip() if complaint and not pd.isna(complaint) else "Not available"
 
-# Output file path
-output_file_path = "###"
+    legend_text = ""
+    if legend and not pd.isna(legend) and str(legend).strip():
+        legend_text = f"\n### Image Legend\n{str(legend).strip()}"
+    else:
+        legend_text = "\n### Image Legend\nNot available"
 
-# Check if the file already exists
-if os.path.exists(output_file_path):
-    output_df = pd.read_excel(output_file_path)
-else:
-    output_df = pd.DataFrame(columns=['Case Number', 'Rank', 'Diagnosis', 'Reason', 'Features'])
+    return prompt_template.render(prompt_layout, sex=sex, age=age, complaint=complaint.strip(), legend_text=legend_text)
 
-image_findings_df = pd.DataFrame(columns=['Case Number', 'Image Findings'])
+# Output file path
+output_file_path = "###"
+image_findings_file_path = "###"
+
+output_columns = ['Case Number', 'Rank', 'Diagnosis', 'Reason', 'Features']
+image_findings_columns = ['Case Number', 'Image Findings']
+
+# Sharding: with num_shards > 1 the (case, repetition) jobs are split by a stable hash and this
+# process runs only shard shard_index (0-based), with its own journal, metrics and output files
+# (<output>_shard<i>of<N>). Set them per machine, or start every shard as a worker process with
+# python -m pipeline.sharding <this script> --shards N. merge_shards folds the shard journals into
+# this condition's journal and writes the final output, reporting duplicate and missing jobs.
+num_shards = int(os.environ.get("NUM_SHARDS", 1))
+shard_index = int(os.environ.get("SHARD_INDEX", 0))
+merge_shards = os.environ.get("MERGE_SHARDS") == "1"
+if os.environ.get("SHARD_API_KEY"):
+    openai.api_key = os.environ["SHARD_API_KEY"]
+if num_shards > 1 and not merge_shards:
+    output_file_path = shard_path(output_file_path, shard_index, num_shards)
+    image_findings_file_path = shard_path(image_findings_file_path, shard_index, num_shards)
+
+# Every finished job is appended to the journal immediately; on restart, jobs that already
+# succeeded are skipped and the Excel output is rebuilt from the journal
+condition = "PI+Image"
+journal = Journal(os.path.splitext(output_file_path)[0] + "_journal.jsonl", condition)
+
+# Results are appended to Parquet parts in <output>_parts after each repetition, and the Excel
+# workbook is written once at the end instead of being rewritten at every checkpoint
+outputs = PartitionedOutput(journal, {"output": output_columns, "image_findings": image_findings_columns},
+                            os.path.splitext(output_file_path)[0] + "_parts")
+# write_result_stores also saves every output table as a compact result store (<output>.results:
+# dictionary-encoded diagnoses, compressed reasoning text, memory-mapped on load), which
+# pipeline.scoring and pipeline.consistency read in place of the workbook
+write_result_stores = False
+
+# Jobs still failing after max_retries are kept in <output>_dead_letter.jsonl with the request sent,
+# the last raw response and the error class (python -m pipeline.dead_letter show <that file>).
+# redrive_dead_letters replays only those requests, and their successful results replace the Error
+# rows in the output; python -m pipeline.dead_letter redrive <this script> sets it for one run.
+dead_letters = DeadLetterStore(os.path.splitext(output_file_path)[0] + "_dead_letter.jsonl", condition)
+redrive_dead_letters = os.environ.get("REDRIVE_DEAD_LETTERS") == "1"
 
 # Set the number of retry attempts
 max_retries = 5
 num_repetition = 3
+max_tokens = 16384
+
+# Models every case is sent to. With several, each case's prompt and images are prepared once and
+# sent to all of them concurrently, and every model gets its own output files (<output>_<model>).
+# model_backends maps a model to the endpoint serving it, e.g. pipeline.backends.OpenAIBackend(
+# base_url=...) for a local OpenAI-compatible server or LocalBackend(respond) in-process; the other
+# models use the OpenAI API
+models = ["gpt-4o"]
+model_backends = {}
+
+# Ask for all repetitions of a case as n choices of a single completion (falls back to
+# separate requests when the endpoint does not support n > 1)
+sample_repetitions_with_n = False
+
+# Adaptive repetitions: instead of num_repetition for every case, request one repetition at a
+# time and stop a case once the top stability_top_k diagnoses of its last two repetitions agree.
+# Every case gets min_repetitions and at most max_repetitions; repetitions left unused by stable
+# cases go to unstable ones, within the num_repetition budget of the fixed schedule. Shards split
+# the repetitions of a case, so keep it off for sharded runs.
+adaptive_repetitions = False
+min_repetitions = 2
+max_repetitions = 5
+stability_top_k = 3
+
+# Account limits (set them to your usage tier) shared by every request of the run;
+# retries back off exponentially with jitter and honour Retry-After on 429 responses
+requests_per_minute = 5000
+tokens_per_minute = 800000
+
+# Hedged requests: once a call has been outstanding longer than hedge_percentile of the recent
+# calls to its model, send a second copy and keep whichever valid response arrives first. The
+# run reports how often it hedged, how often the copy won and the tokens the copies cost.
+hedge_requests = False
+hedge_percentile = 95
+
+# Optionally load every image once (from image_dir, or its URL when it is not there), downscale it
+# to the model's tile geometry for image_detail ("low", "high" or "auto") and send it inline as a
+# cached base64 data URI instead of letting the provider fetch the full-resolution URL
+preprocess_images = False
+# image_dir mirrors the links by host and path (<image_dir>/<host>/<path>, e.g. from wget -x), or is
+# a dict mapping each link to its local file
+image_dir = None
+image_cache_dir = "image_cache"
+# image_detail None sends no detail field (the API default, "auto") unless images are preprocessed
+image_detail = None
+
+# Preprocessed images are registered by content: an image behind several links or cases is encoded
+# and uploaded once and every request references its handle. image_uploader None keeps images
+# inline as data URIs; DirectoryUploader(directory, base_url) publishes each one to a folder served
+# at base_url so requests carry only its URL. image_dedup_distance also merges look-alike copies
+# whose perceptual hashes differ by at most that many bits (None: identical bytes only).
+image_uploader = None
+image_dedup_distance = None
+
+# "serial" waits on one request at a time, "async" keeps up to max_concurrency requests in flight,
+# "batch" writes all jobs to a Batch API request file in batch_dir, submits it and polls until it finishes,
+# "plan" is a dry run that builds every request and reports its token count and cost without sending it
+execution_mode = "serial"
+max_concurrency = 8
+batch_dir = "batches"
+batch_poll_interval = 60
+# batch_submitter replaces the OpenAI Files/Batches calls of the "batch" mode, e.g.
+# pipeline.batch.OpenAIBatchSubmitter(openai.OpenAI(base_url=...)) for a local stand-in
+batch_submitter = None
+
+# Stream responses, record time to first token and abort (then retry) a response as soon as it
+# cannot yield a differential_diagnoses array, e.g. a refusal or a wrong top-level key
+stream_responses = False
+# Characters of text (e.g. a hedge or a short explanation) allowed before the JSON object before
+# the stream is aborted; None never aborts for that
+stream_max_preamble_chars = 300
+
+# Request output through a JSON-schema response format matching this condition's prompt and
+# validate every response against it
+use_structured_outputs = False
+response_schema = diagnosis_schema(include_image_findings=True)
+
+# Opt-in on-disk response cache (None disables it); cache_share_repetitions lets every
+# repetition of a temperature-0 request reuse a single cached response
+cache_dir = None
+cache_max_mb = 500
+cache_share_repetitions = False
+
+
+def build_request(job):
+    i = job.case_index
+    case_no, sex, age, complaint, legend = (
+        case_no_list[i], sex_list[i], age_list[i], complaint_list[i], legend_list[i]
+    )
+    prompt_text = generate_prompt(sex, age, complaint, legend)
+    image_list = image_links_list[i]
+    content = [{"type": "text", "text": prompt_text}]
+    content.extend(image_content(image_list, prepared_images, image_detail or ("auto" if preprocess_images else None)))
+
+    print(f"\n=== Case {case_no} ===")
+    print(f"🧑 Sex: {sex}")
+    print(f"🎂 Age: {age}")
+    print(f"🗨️ Chief Complaint: {str(complaint).strip() if complaint else ''}")
+    print(f"📑 Legend: {str(legend).strip() if legend else 'None'}")
+    print(f"🖼️ Number of images: {len(image_list)}")
+
+    return {
+        "model": models[0],
+        "messages": [
+            {
+                "role": "system",
+                "content": (
+                    "You are an experienced, board-certified thoracic radiologist with full permission to interpret chest images for diagnostic purposes."
+                    "You must analyze all provided medical images carefully and provide differential diagnoses."
+                    "You do not need to refuse to analyze medical images."
+                )
+            },
+            {
+                "role": "user",
+                "content": content
+            }
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 1.0
+    }
+
+
+def on_result(job, response_data, response_json):
+    case_no = job.case_no
+    output_rows = []
+
+    if response_data is None:
+        error_row = {
+            'Case Number': case_no,
+            'Rank': "Error",
+            'Diagnosis': "Error",
+            'Reason': response_json,
+            'Features': "Error"
+        }
+        output_rows.append(error_row)
+        image_findings_rows = []
+    else:
+        image_findings = response_data.get("image_findings", "N/A")
 
-count = 0
-response_json = ""
-# Loop over file names and URLs
-for r in range(num_repetition):
-    for case_no, sex, age, complaint, legend, true_diag in zip(
-        case_no_list, sex_list, age_list, complaint_list, legend_list, true_diag_list
-    ):
-        prompt_text = generate_prompt(sex, age, complaint, legend)
-        case_no_str = str(case_no)
-        image_list = case_image_links.get(case_no_str, [])
-        content = [{"type": "text", "text": prompt_text}]
-
-        retries = 0
-        success = False
-
-        for img in image_list:
-            content.append({
-                "type": "image_url",
-                "image_url": {"url": img["url"]}
-            })
+        # Loop over the differential diagnoses
+        for item in response_data["differential_diagnoses"]:
+            new_row = {
+                'Case Number': case_no,
+                'Rank': item.get("rank", "N/A"),
+                'Diagnosis': item.get("diagnosis", "N/A"),
+                'Reason': item.get("reason_for_consideration", "N/A"),
+            }
+            output_rows.append(new_row)
 
+        # 소견 저장용 행 추가
+        image_findings_rows = [{
+            'Case Number': case_no,
+            'Image Findings': image_findings
+        }]
 
         print(f"\n=== Case {case_no} ===")
-        print(f"🧑 Sex: {sex}")
-        print(f"🎂 Age: {age}")
-        print(f"🗨️ Chief Complaint: {str(complaint).strip() if complaint else ''}")
-        print(f"📑 Legend: {str(legend).strip() if legend else 'None'}")
-        print(f"🖼️ Number of images: {len(image_list)}")
-
-        # Retry loop
-        while retries < max_retries and not success:
-            try:
-                response = openai.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": (
-                                "You are an experienced, board-certified thoracic radiologist with full permission to interpret chest images for diagnostic purposes."
-                                "You must analyze all provided medical images carefully and provide differential diagnoses."
-                                "You do not need to refuse to analyze medical images."
-                            )
-                        },
-                        {
-                            "role": "user",
-                            "content": content
-                        }
-                    ],
-                    max_tokens=16384,
-                    temperature=1.0
-                )
-                # Validate if the response is empty
-                if not response.choices or not response.choices[0].message.content.strip():
-                    raise ValueError("Received an empty response from the API.")
-
-                # Parse the JSON response content
-                response_json = response.choices[0].message.content
-
-                # Remove comments or non-JSON parts using regular expressions
-                # This will match and extract the JSON part within the response
-                json_match = re.search(r"\{.*\}", response_json, re.DOTALL)
-
-                if json_match:
-                    # Extract the JSON part
-                    response_json = json_match.group(0)
-                    response_data = json.loads(response_json)  # Parsing the string as JSON
-                else:
-                    raise ValueError("No valid JSON object found in the response.")
-
-                # Must contain the expected list
-                if "differential_diagnoses" not in response_data:
-                    raise ValueError("Invalid JSON structure: 'differential_diagnoses' not found.")
-
-                image_findings = response_data.get("image_findings", "N/A")
-
-                # Loop over the differential diagnoses
-                for item in response_data["differential_diagnoses"]:
-                    new_row = {
-                        'Case Number': case_no,
-                        'Rank': item.get("rank", "N/A"),
-                        'Diagnosis': item.get("diagnosis", "N/A"),
-                        'Reason': item.get("reason_for_consideration", "N/A"),
-                    }
-                    output_df = pd.concat([output_df, pd.DataFrame([new_row])], ignore_index=True)
-
-                # 소견 저장용 행 추가
-                image_findings_df = pd.concat([image_findings_df, pd.DataFrame([{
-                    'Case Number': case_no,
-                    'Image Findings': image_findings
-                }])], ignore_index=True)
-
-                print(f"\n=== Case {case_no} ===")
-                print(f"✅ True Diagnosis: {true_diag}")
-                print(f"Image findings: {image_findings}")
-
-                for item in response_data["differential_diagnoses"]:
-                    print(f"Rank: {item.get('rank')}, Diagnosis: {item.get('diagnosis')}")
-
-                success = True
-            except Exception as e:
-                retries += 1
-                print(f"Error processing {case_no}: {str(e)}")
-                print(f"Retrying {retries}/{max_retries}...")
-                time.sleep(2)
-
-        if not success:
-            error_row = {
-                'Case Number': case_no,
-                'Rank': "Error",
-                'Diagnosis': "Error",
-                'Reason': response_json,
-                'Features': "Error"
-            }
-            output_df = pd.concat([output_df, pd.DataFrame([error_row])], ignore_index=True)
-    # Save the updated DataFrame to Excel after each iteration
-    image_findings_df.to_excel("###", index=False)
-    output_df.to_excel(output_file_path, index=False)
-print("The results have been saved to the Excel file.")
\ No newline at end of file
+        print(f"✅ True Diagnosis: {true_diag_list[job.case_index]}")
+        print(f"Image findings: {image_findings}")
+
+        for item in response_data["differential_diagnoses"]:
+            print(f"Rank: {item.get('rank')}, Diagnosis: {item.get('diagnosis')}")
+
+    journal.record(job, response_data is not None, output=output_rows, image_findings=image_findings_rows)
+
+    # Append the repetition's results to the Parquet parts
+    if job.case_index == len(case_no_list) - 1:
+        outputs.flush()
+
+
+def save_outputs():
+    for model, path in model_outputs(image_findings_file_path, models):
+        outputs.export("image_findings", path, model)
+        if write_result_stores:
+            export_result_store(outputs, "image_findings", os.path.splitext(path)[0] + ".results", model)
+    for model, path in model_outputs(output_file_path, models):
+        outputs.export("output", path, model)
+        if write_result_stores:
+            export_result_store(outputs, "output", os.path.splitext(path)[0] + ".results", model)
+
+
+if execution_mode != "plan":
+    # Workbooks written without a journal would be overwritten by the first export
+    check_existing_outputs(journal, [path for base in (output_file_path, image_findings_file_path)
+                                     for _, path in model_outputs(base, models)])
+
+prepared_images = {}
+image_registry = None
+if preprocess_images and not merge_shards:
+    image_registry = ImageRegistry(ImagePreprocessor(image_cache_dir, image_dir, image_detail or "auto"),
+                                   image_uploader, image_dedup_distance)
+    prepared_images = image_registry.prepare(image_links_list)
+
+all_jobs = fan_out(make_jobs(case_no_list, max_repetitions if adaptive_repetitions else num_repetition), models)
+if num_shards > 1 and not merge_shards:
+    all_jobs = shard_jobs(all_jobs, shard_index, num_shards)
+    batch_dir = shard_path(batch_dir, shard_index, num_shards)
+jobs = [job for job in all_jobs if not journal.is_done(job)]
+if len(jobs) < len(all_jobs):
+    print(f"📒 Resuming from journal: {len(all_jobs) - len(jobs)} of {len(all_jobs)} jobs already done")
+if redrive_dead_letters:
+    jobs = [job for job in dead_letters.jobs() if not journal.is_done(job)]
+    print(f"📮 Re-driving {len(jobs)} dead-lettered jobs")
+if image_registry is not None:
+    image_registry.report([image_links_list[job.case_index] for job in jobs])
+
+adaptive = None
+if adaptive_repetitions:
+    adaptive = AdaptiveSampling(min_repetitions, max_repetitions, num_repetition, stability_top_k).seed(journal)
+
+cache = None
+if cache_dir:
+    cache = ResponseCache(cache_dir, cache_max_mb * 1024 * 1024, cache_share_repetitions)
+
+if merge_shards:
+    merge_shard_journals(journal, output_file_path, num_shards, all_jobs, dead_letters)
+    save_outputs()
+    print("The merged results have been saved to the Excel file.")
+elif execution_mode == "plan":
+    planner = TokenPlanner(models[0], output_token_history(os.path.splitext(output_file_path)[0] + "_metrics.xlsx"))
+    plan_df = planner.plan(jobs, build_request, sample_repetitions_with_n)
+    plan_df.to_excel(os.path.splitext(output_file_path)[0] + "_plan.xlsx", index=False)
+    planner.report(plan_df, max_tokens)
+else:
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+    # A re-drive sends the requests stored with the dead-lettered jobs
+    request_builder = dead_letters.replay(build_request) if redrive_dead_letters else build_request
+    run_jobs(jobs, request_builder, on_result, mode=execution_mode,
+             max_concurrency=max_concurrency, max_retries=max_retries, rate_limiter=rate_limiter, cache=cache,
+             batch_submitter=batch_submitter, batch_dir=batch_dir, batch_poll_interval=batch_poll_interval,
+             sample_with_n=sample_repetitions_with_n, stream=stream_responses,
+             stream_max_preamble=stream_max_preamble_chars,
+             response_schema=response_schema if use_structured_outputs else None, condition=condition,
+             metrics_path=os.path.splitext(output_file_path)[0] + "_metrics.xlsx",
+             backends=model_backends, dead_letters=dead_letters, adaptive=adaptive,
+             hedging=HedgingPolicy(hedge_percentile) if hedge_requests else None)
+    save_outputs()
+    print("The results have been saved to the Excel file.")
@@ -0,0 +1,175 @@
+import argparse
+import ast
+import contextlib
+import csv
+import io
+import os
+import time
+import tracemalloc
+
+import openai
+
+from benchmarks.mock_server import MockConfig, MockServer
+from pipeline.dispatch import make_jobs, run_jobs
+from pipeline.rate_limit import RateLimiter
+from pipeline.results import ResultCollector
+
+# End-to-end throughput benchmark of the request path (run_jobs, retries, rate limiting,
+# streaming, parsing) against the local mock server. Requests are built by each condition
+# script's own generate_prompt and build_request, run on synthetic cases, so the prompt rendering
+# and image content of every request are part of the measured cost.
+# Run from the repository root: python -m benchmarks.bench_pipeline [--cases 50] [--output bench.csv]
+
+CONDITIONS = {
+    # condition: (images per case, findings/legend chars)
+    "PI": (0, 0),
+    "PI+Text": (0, 900),
+    "PI+Image": (2, 200),
+    "PI+Image+Text": (2, 900),
+}
+# Top-level definitions a script's build_request needs; the rest of the script (loading the
+# workbook, the journal, the run itself) is left out
+BUILDER_NAMES = {"prompt_template", "prompt_layout", "generate_prompt", "build_request", "models", "max_tokens",
+                 "preprocess_images", "image_detail"}
+SCENARIOS = {
+    # scenario: (mode, stream, MockConfig overrides)
+    "serial": ("serial", False, {}),
+    "async": ("async", False, {}),
+    "async+stream": ("async", True, {}),
+    "async+faults": ("async", False, {"rate_limit_rate": 0.05, "server_error_rate": 0.03,
+                                      "malformed_rate": 0.03, "refusal_rate": 0.02}),
+}
+OUTPUT_COLUMNS = ['Case Number', 'Rank', 'Diagnosis', 'Reason', 'Features']
+CSV_COLUMNS = [
+    "timestamp", "condition", "scenario", "jobs", "cases_per_s", "wall_clock_s", "attempts",
+    "retry_overhead", "backoff_s", "failed_jobs", "peak_memory_mb",
+]
+
+
+def _defines(node):
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return True
+    if isinstance(node, ast.FunctionDef):
+        return node.name in BUILDER_NAMES
+    return isinstance(node, ast.Assign) and any(
+        isinstance(target, ast.Name) and target.id in BUILDER_NAMES for target in node.targets
+    )
+
+
+def make_build_request(condition, case_no_list):
+    # The build_request of <condition>.py, over synthetic case lists
+    images, case_chars = CONDITIONS[condition]
+    with open(f"{condition}.py", "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), f"{condition}.py")
+    tree.body = [node for node in tree.body if _defines(node)]
+    text = ("Findings text. " * (case_chars // 15)) or None
+    namespace = {
+        "case_no_list": case_no_list,
+        "sex_list": ["F" if case_no % 2 else "M" for case_no in case_no_list],
+        "age_list": [40 + case_no % 40 for case_no in case_no_list],
+        "complaint_list": ["Cough and fever for two weeks"] * len(case_no_list),
+        "findings_list": [text] * len(case_no_list),
+        "legend_list": [text] * len(case_no_list),
+        "image_links_list": [
+            [{"url": f"https://images.invalid/{case_no}/{i}.jpg"} for i in range(images)] for case_no in case_no_list
+        ],
+        "prepared_images": {},
+    }
+    exec(compile(tree, f"{condition}.py", "exec"), namespace)
+    return namespace["build_request"]
+
+
+def run_scenario(condition, scenario, num_cases, num_repetition, max_concurrency, latency_median_s):
+    # Returns (run_jobs stats, jobs, failed jobs)
+    mode, stream, overrides = SCENARIOS[scenario]
+    config = MockConfig(latency_median_s=latency_median_s, time_to_first_token_s=latency_median_s / 4,
+                        retry_after_s=0.05, seed=0, **overrides)
+    output_rows = ResultCollector(OUTPUT_COLUMNS)
+    failed = []
+
+    def on_result(job, response_data, response_json):
+        if response_data is None:
+            failed.append(job)
+            return
+        for item in response_data["differential_diagnoses"]:
+            output_rows.append({
+                'Case Number': job.case_no,
+                'Rank': item.get("rank"),
+                'Diagnosis': item.get("diagnosis"),
+                'Reason': item.get("reason_for_consideration"),
+                'Features': item.get("distinguishing_features"),
+            })
+
+    case_no_list = list(range(1, num_cases + 1))
+    jobs = make_jobs(case_no_list, num_repetition)
+    build_request = make_build_request(condition, case_no_list)
+    with MockServer(config) as server:
+        openai.base_url = server.base_url
+        # The mock enforces no account limits, so the limiter only paces retries here
+        limiter = RateLimiter(requests_per_minute=10 ** 6, tokens_per_minute=10 ** 10, base_delay=0.05, max_delay=1.0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = run_jobs(jobs, build_request, on_result, mode=mode,
+                             max_concurrency=max_concurrency, max_retries=5, rate_limiter=limiter,
+                             stream=stream, condition=condition)
+    output_rows.to_frame()
+    return stats, jobs, failed
+
+
+def bench(condition, scenario, num_cases, num_repetition, max_concurrency, latency_median_s):
+    stats, jobs, failed = run_scenario(condition, scenario, num_cases, num_repetition, max_concurrency,
+                                       latency_median_s)
+    # Memory is traced in a second pass; tracemalloc slows the interpreter too much to time that run
+    tracemalloc.start()
+    run_scenario(condition, scenario, num_cases, num_repetition, max_concurrency, latency_median_s)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    attempts = stats["parsing"]["attempts"]
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "condition": condition,
+        "scenario": scenario,
+        "jobs": len(jobs),
+        "cases_per_s": stats["requests_per_s"],
+        "wall_clock_s": stats["wall_clock_s"],
+        "attempts": attempts,
+        "retry_overhead": attempts / len(jobs) - 1 if jobs else 0.0,
+        "backoff_s": stats["rate_limiter"]["backoff_s"],
+        "failed_jobs": len(failed),
+        "peak_memory_mb": peak / 1024 / 1024,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput benchmark against the mock server")
+    parser.add_argument("--cases", type=int, default=20)
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05, help="median mock latency in seconds")
+    parser.add_argument("--conditions", nargs="*", default=list(CONDITIONS))
+    parser.add_argument("--scenarios", nargs="*", default=list(SCENARIOS))
+    parser.add_argument("--output", help="CSV file the results are appended to, for regression tracking")
+    args = parser.parse_args()
+
+    # Retries are left to the pipeline's own rate limiter, as in the scripts' error accounting
+    openai.api_key = "mock"
+    openai.max_retries = 0
+
+    print(f"{'condition':>14} | {'scenario':>13} | {'jobs':>5} | {'cases/s':>8} | {'retry ovh':>9} | "
+          f"{'backoff':>8} | {'failed':>6} | {'peak MB':>7}")
+    results = []
+    for condition in args.conditions:
+        for scenario in args.scenarios:
+            result = bench(condition, scenario, args.cases, args.repetitions, args.concurrency, args.latency)
+            results.append(result)
+            print(f"{condition:>14} | {scenario:>13} | {result['jobs']:>5} | {result['cases_per_s']:>8.2f} | "
+                  f"{result['retry_overhead']:>9.1%} | {result['backoff_s']:>7.2f}s | {result['failed_jobs']:>6} | "
+                  f"{result['peak_memory_mb']:>7.1f}")
+
+    if args.output:
+        new_file = not os.path.exists(args.output)
+        with open(args.output, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(results)
@@ -0,0 +1,47 @@
+import time
+
+import pandas as pd
+
+from pipeline.results import ResultCollector
+
+# Compares the old per-row pd.concat accumulation with ResultCollector.
+# Run from the repository root: python -m benchmarks.bench_results
+
+COLUMNS = ['Case Number', 'Rank', 'Diagnosis', 'Reason', 'Features']
+SIZES = [500, 1000, 2000, 4000, 8000]
+
+
+def make_row(i):
+    return {
+        'Case Number': i // 5,
+        'Rank': i % 5 + 1,
+        'Diagnosis': f"Diagnosis {i % 37}",
+        'Reason': "Reason for consideration " * 8,
+        'Features': "Distinguishing features " * 8,
+    }
+
+
+def bench_concat(n):
+    output_df = pd.DataFrame(columns=COLUMNS)
+    start = time.perf_counter()
+    for i in range(n):
+        output_df = pd.concat([output_df, pd.DataFrame([make_row(i)])], ignore_index=True)
+    return time.perf_counter() - start
+
+
+def bench_collector(n):
+    output_rows = ResultCollector(COLUMNS)
+    start = time.perf_counter()
+    for i in range(n):
+        output_rows.append(make_row(i))
+    output_rows.to_frame()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    print(f"{'rows':>6} | {'concat total':>12} | {'concat/row':>10} | {'collector total':>15} | {'collector/row':>13}")
+    for n in SIZES:
+        concat_s = bench_concat(n)
+        collector_s = bench_collector(n)
+        print(f"{n:>6} | {concat_s:>11.3f}s | {concat_s / n * 1e6:>8.1f}us | "
+              f"{collector_s:>14.4f}s | {collector_s / n * 1e6:>11.2f}us")
@@ -0,0 +1,103 @@
+import itertools
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from pipeline.consistency import RBO_P, consistency
+from pipeline.scoring import TOP_K, normalize
+
+# Checks the vectorized metrics of pipeline.consistency against a plain per-pair loop on
+# synthetic outputs with failed jobs, lists of different lengths, blank names and names repeated
+# within a list (e.g. the same diagnosis in another case or spelling), then times a large run.
+# Run from the repository root: python -m benchmarks.check_consistency
+
+NAMES = [f"Diagnosis {i}" for i in range(10)]
+TOLERANCE = 1e-9
+
+
+def make_output(cases, repetitions, rng):
+    rows = []
+    for repetition in range(repetitions):
+        for case in range(cases):
+            if rng.random() < 0.05:
+                rows.append({'Case Number': case, 'Rank': "Error", 'Diagnosis': "Error", 'Repetition': repetition})
+                continue
+            for rank in range(1, rng.randint(1, 7) + 1):
+                name = rng.choice(NAMES[:7])
+                roll = rng.random()
+                if roll < 0.1:
+                    name = f"{name.upper()} (suspected)."
+                elif roll < 0.15:
+                    name = ""
+                rows.append({'Case Number': case, 'Rank': rank, 'Diagnosis': name, 'Repetition': repetition})
+    return pd.DataFrame(rows)
+
+
+def reference_lists(output_df):
+    # (repetition, case) -> names in rank order; None for blank names and for a name already
+    # listed at a better rank
+    df = output_df[pd.to_numeric(output_df['Rank'], errors="coerce").notna()]
+    df = df.assign(Name=normalize(df['Diagnosis']))
+    lists = {}
+    for (repetition, case), group in df.groupby(['Repetition', 'Case Number']):
+        names = []
+        for name in group.sort_values('Rank')['Name']:
+            names.append(name if name and name not in names else None)
+        lists[(repetition, str(case))] = names
+    return lists
+
+
+def reference_metrics(a, b, top_k=TOP_K, p=RBO_P):
+    def overlap(d):
+        return len(({name for name in a[:d]} & {name for name in b[:d]}) - {None})
+
+    metrics = {f'Overlap@{k}': overlap(k) / k for k in top_k}
+    depth = max(len(a), len(b))
+    rbo = sum(overlap(d) / d * p ** d for d in range(1, depth + 1))
+    metrics['RBO'] = (1 - p) / p * rbo + overlap(depth) / depth * p ** depth
+    shared = [name for name in a if name is not None and name in b]
+    concordant = discordant = 0
+    for x, y in itertools.combinations(shared, 2):
+        if b.index(x) < b.index(y):
+            concordant += 1
+        else:
+            discordant += 1
+    compared = concordant + discordant
+    metrics['Kendall Tau'] = (concordant - discordant) / compared if compared else np.nan
+    metrics['Shared'] = len(shared)
+    return metrics
+
+
+def check(outputs):
+    # Number of pairs whose vectorized metrics differ from the reference
+    pairs_df, _ = consistency(outputs)
+    lists = {condition: reference_lists(output_df) for condition, output_df in outputs.items()}
+    mismatches = 0
+    for row in pairs_df.to_dict("records"):
+        a = lists[row['Condition A']][(row['Repetition A'], row['Case Number'])]
+        b = lists[row['Condition B']][(row['Repetition B'], row['Case Number'])]
+        for metric, expected in reference_metrics(a, b).items():
+            actual = row[metric]
+            if np.isnan(expected) and np.isnan(actual):
+                continue
+            if not abs(expected - actual) <= TOLERANCE:
+                mismatches += 1
+                print(f"{metric} of {row['Condition A']} rep {row['Repetition A']} vs {row['Condition B']} "
+                      f"rep {row['Repetition B']}, case {row['Case Number']}: {actual} != {expected} ({a} / {b})")
+                break
+    return len(pairs_df), mismatches
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    checked, mismatches = check({'A': make_output(60, 4, rng), 'B': make_output(60, 3, rng)})
+    print(f"{checked} pairs checked against the per-pair loop, {mismatches} mismatches")
+
+    large = {'A': make_output(3000, 5, rng), 'B': make_output(3000, 5, rng)}
+    start = time.perf_counter()
+    pairs_df, _ = consistency(large)
+    print(f"{len(pairs_df):,} pairs in {time.perf_counter() - start:.2f}s")
+    sys.exit(1 if mismatches else 0)
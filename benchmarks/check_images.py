@@ -0,0 +1,59 @@
+import base64
+import io
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from pipeline.images import ImagePreprocessor, perceptual_hash
+
+# Regression check for high bit-depth radiographs: a 12-bit gradient stored as a 16-bit grayscale
+# PNG (and as 32-bit integer and float TIFFs) must come out of the preprocessor as a full 8-bit
+# gradient, not clipped to white, and must not share its perceptual hash with the reversed gradient.
+# Run from the repository root: python -m benchmarks.check_images
+
+WIDTH, HEIGHT = 600, 400
+
+
+def gradient(dtype, reverse=False):
+    # 0..4095 from left to right (or right to left), as a 12-bit detector writes it; the image
+    # mode follows from dtype
+    ramp = np.linspace(0, 4095, WIDTH)
+    image = Image.fromarray(np.tile(ramp[::-1] if reverse else ramp, (HEIGHT, 1)).astype(dtype))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG" if image.mode == "I;16" else "TIFF")
+    return image.mode, buffer.getvalue()
+
+
+def decoded_pixels(data_uri):
+    raw = base64.b64decode(data_uri.split(",", 1)[1])
+    return np.asarray(Image.open(io.BytesIO(raw)).convert("L"), dtype=np.float64)
+
+
+def check(dtype):
+    # (image mode, problems found with it; empty when it is handled correctly)
+    mode, raw = gradient(dtype)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        pixels = decoded_pixels(ImagePreprocessor(cache_dir).encoded(raw, f"check-{mode}"))
+    problems = []
+    saturated = float((pixels >= 254).mean())
+    if saturated > 0.05:
+        problems.append(f"{saturated:.1%} of pixels saturated")
+    if pixels.max() - pixels.min() < 200:
+        problems.append(f"range {pixels.min():.0f}-{pixels.max():.0f} instead of about 0-255")
+    columns = pixels.mean(axis=0)
+    if not np.all(np.diff(columns[::20]) >= 0):
+        problems.append("gradient is not monotonic")
+    if perceptual_hash(raw) == perceptual_hash(gradient(dtype, reverse=True)[1]):
+        problems.append("the gradient and its reverse share a perceptual hash")
+    return mode, problems
+
+
+if __name__ == "__main__":
+    failures = 0
+    for dtype in (np.uint16, np.int32, np.float32):
+        mode, problems = check(dtype)
+        failures += bool(problems)
+        print(f"{mode}: {'; '.join(problems) if problems else 'ok'}")
+    sys.exit(1 if failures else 0)
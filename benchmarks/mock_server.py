@@ -0,0 +1,280 @@
+import argparse
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the chat-completions endpoint, so the request path (dispatch, retries,
+# rate limiting, streaming, parsing) can be exercised and benchmarked offline. Point a run at
+# it with openai.base_url = server.base_url (or OPENAI_BASE_URL). Responses are generated
+# differential_diagnoses JSON; latency and failure modes are drawn from MockConfig.
+# Standalone: python -m benchmarks.mock_server --port 8000 --rate-limit-rate 0.05
+
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 765
+# Minimum prompt prefix the provider caches
+CACHE_MIN_TOKENS = 1024
+REFUSAL = "I'm sorry, but I can't help with identifying a diagnosis from this information."
+DIAGNOSES = [
+    "Invasive mucinous adenocarcinoma", "Organizing pneumonia", "Pulmonary sarcoidosis",
+    "Hypersensitivity pneumonitis", "Pulmonary alveolar proteinosis", "Lymphangioleiomyomatosis",
+    "Pulmonary Langerhans cell histiocytosis", "Granulomatosis with polyangiitis",
+]
+
+
+class MockConfig:
+    # Latency is lognormal around latency_median_s; the *_rate values are per-request probabilities
+    def __init__(self, latency_median_s=0.5, latency_sigma=0.5, time_to_first_token_s=0.2,
+                 rate_limit_rate=0.0, server_error_rate=0.0, malformed_rate=0.0, refusal_rate=0.0,
+                 retry_after_s=1.0, reason_chars=400, seed=None):
+        self.latency_median_s = latency_median_s
+        self.latency_sigma = latency_sigma
+        self.time_to_first_token_s = time_to_first_token_s
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.malformed_rate = malformed_rate
+        self.refusal_rate = refusal_rate
+        self.retry_after_s = retry_after_s
+        self.reason_chars = reason_chars
+        self.seed = seed
+
+
+def _prompt_parts(body):
+    text, images = [], 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            text.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                text.append(part["text"])
+            elif part.get("type") == "image_url":
+                images += 1
+    return "\n".join(text), images
+
+
+class MockBackend:
+    # Generates completions and keeps the request counters; shared by all handler threads
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.prefixes = set()
+        self.counts = {"requests": 0, "rate_limited": 0, "server_errors": 0, "malformed": 0, "refusals": 0}
+
+    def draw(self):
+        # (failure-mode roll, latency, generator for the response content) of one request
+        with self.lock:
+            self.counts["requests"] += 1
+            roll = self.random.random()
+            latency = self.random.lognormvariate(0, self.config.latency_sigma) * self.config.latency_median_s
+            return roll, latency, random.Random(self.random.getrandbits(64))
+
+    def _count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def failure(self, roll):
+        # (status, error type) for a simulated API error, or None
+        if roll < self.config.rate_limit_rate:
+            self._count("rate_limited")
+            return 429, "rate_limit_exceeded"
+        if roll < self.config.rate_limit_rate + self.config.server_error_rate:
+            self._count("server_errors")
+            return 500, "server_error"
+        return None
+
+    def content(self, body, roll, rng):
+        offset = self.config.rate_limit_rate + self.config.server_error_rate
+        if roll < offset + self.config.refusal_rate:
+            self._count("refusals")
+            return REFUSAL
+        text, _ = _prompt_parts(body)
+        schema = ((body.get("response_format") or {}).get("json_schema") or {}).get("schema") or {}
+        with_findings = "image_findings" in schema.get("properties", {}) or '"image_findings"' in text
+        reason = "Consistent with the described findings. " * (self.config.reason_chars // 40)
+        result = {
+            "differential_diagnoses": [
+                {
+                    "rank": str(rank),
+                    "diagnosis": rng.choice(DIAGNOSES),
+                    "reason_for_consideration": reason,
+                    "distinguishing_features": "Distribution and patient context favour it.",
+                }
+                for rank in range(1, 6)
+            ],
+        }
+        if with_findings:
+            result = {"image_findings": "Bilateral ground-glass opacities with lower-lobe predominance.", **result}
+        content = "```json\n" + json.dumps(result, indent=2) + "\n```"
+        if roll < offset + self.config.refusal_rate + self.config.malformed_rate:
+            self._count("malformed")
+            # Truncated mid-object, as a response cut off by max_tokens would be
+            return content[:len(content) // 2]
+        return content
+
+    def usage(self, body, contents):
+        text, images = _prompt_parts(body)
+        prompt_tokens = len(text) // CHARS_PER_TOKEN + images * IMAGE_TOKENS
+        # A repeated first CACHE_MIN_TOKENS tokens counts as a cache hit on that prefix
+        prefix_chars = CACHE_MIN_TOKENS * CHARS_PER_TOKEN
+        cached = 0
+        if len(text) >= prefix_chars:
+            key = hashlib.sha256(text[:prefix_chars].encode("utf-8")).hexdigest()
+            with self.lock:
+                if key in self.prefixes:
+                    cached = CACHE_MIN_TOKENS
+                self.prefixes.add(key)
+        completion_tokens = sum(len(content) for content in contents) // CHARS_PER_TOKEN
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    backend = None
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without this Nagle's algorithm adds ~40ms
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        backend = self.backend
+        roll, latency, rng = backend.draw()
+        failure = backend.failure(roll)
+        if failure is not None:
+            time.sleep(min(latency, backend.config.time_to_first_token_s))
+            status, error_type = failure
+            headers = {"Retry-After": str(backend.config.retry_after_s)} if status == 429 else None
+            self._send_json(status, {"error": {"message": f"Simulated {error_type}", "type": error_type,
+                                               "code": error_type}}, headers)
+            return
+
+        n = body.get("n", 1)
+        contents = [backend.content(body, roll, rng) for _ in range(n)]
+        usage = backend.usage(body, contents)
+        if body.get("stream"):
+            self._stream(body, contents, usage, latency)
+            return
+        time.sleep(latency)
+        self._send_json(200, {
+            "id": f"chatcmpl-mock-{backend.counts['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [
+                {"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                for i, content in enumerate(contents)
+            ],
+            "usage": usage,
+        })
+
+    def _stream(self, body, contents, usage, latency):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        base = {"id": "chatcmpl-mock-stream", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body.get("model", "mock")}
+        pieces = [(i, content[start:start + 64]) for i, content in enumerate(contents)
+                  for start in range(0, len(content), 64)]
+        ttft = min(self.backend.config.time_to_first_token_s, latency)
+        delay = (latency - ttft) / max(len(pieces), 1)
+        try:
+            time.sleep(ttft)
+            for i, piece in pieces:
+                chunk = dict(base, choices=[{"index": i, "delta": {"content": piece}, "finish_reason": None}])
+                self._write_event(json.dumps(chunk))
+                time.sleep(delay)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._write_event(json.dumps(dict(base, choices=[], usage=usage)))
+            self._write_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client aborted the stream early
+            pass
+
+    def _write_event(self, data):
+        event = f"data: {data}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+        self.wfile.flush()
+
+
+class MockServer:
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.backend = MockBackend(config or MockConfig())
+        handler = type("MockHandler", (_Handler,), {"backend": self.backend})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible chat-completions stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-median", type=float, default=0.5)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--refusal-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    config = MockConfig(latency_median_s=args.latency_median, latency_sigma=args.latency_sigma,
+                        rate_limit_rate=args.rate_limit_rate, server_error_rate=args.server_error_rate,
+                        malformed_rate=args.malformed_rate, refusal_rate=args.refusal_rate, seed=args.seed)
+    server = MockServer(config, args.host, args.port)
+    print(f"Mock chat-completions server on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1 @@
+# Shared request/response pipeline used by the PI, PI+Text, PI+Image and PI+Image+Text scripts
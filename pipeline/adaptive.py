@@ -0,0 +1,118 @@
+import itertools
+
+import pandas as pd
+
+from pipeline.scoring import normalize
+
+# Adaptive repetitions. Instead of a fixed number of repetitions per case, run_jobs requests one
+# repetition at a time: every case (per model) gets min_repetitions, and further repetitions, up
+# to max_repetitions, only while its ranked differential_diagnoses still disagree. A case is
+# stable once the top_k diagnoses of its last `window` repetitions overlap by at least
+# min_agreement on average over pairs (1.0: the same top_k names in any order; top_k=1 asks for
+# the same leading diagnosis). With fixed_repetitions the total number of jobs stays within the
+# fixed schedule, and what stable cases leave unused goes to the least stable ones first.
+
+
+class AdaptiveSampling:
+
+    def __init__(self, min_repetitions=2, max_repetitions=5, fixed_repetitions=None, top_k=3, min_agreement=1.0,
+                 window=2):
+        if not 1 <= min_repetitions <= max_repetitions:
+            raise ValueError(f"Need 1 <= min_repetitions <= max_repetitions, got {min_repetitions}, {max_repetitions}")
+        self.min_repetitions = min_repetitions
+        self.max_repetitions = max_repetitions
+        self.fixed_repetitions = fixed_repetitions
+        self.top_k = top_k
+        self.min_agreement = min_agreement
+        self.window = max(window, 2)
+        self._units = set()
+        # unit -> {repetition: normalized top_k names} of the successful repetitions
+        self._diagnoses = {}
+        # unit -> repetitions requested, failed ones included
+        self._attempted = {}
+
+    @staticmethod
+    def _unit(case_no, model):
+        # One case of one model
+        return str(case_no), model
+
+    def _observe(self, unit, repetition, diagnoses):
+        self._units.add(unit)
+        self._attempted.setdefault(unit, set()).add(repetition)
+        if diagnoses is not None:
+            names = normalize(pd.Series(list(diagnoses)[:self.top_k], dtype=object)).tolist()
+            self._diagnoses.setdefault(unit, {})[repetition] = names
+
+    def observe(self, job, response_data):
+        diagnoses = None
+        if response_data is not None:
+            diagnoses = [item.get("diagnosis") for item in response_data.get("differential_diagnoses", [])]
+        self._observe(self._unit(job.case_no, job.model), job.repetition, diagnoses)
+
+    def observing(self, on_result):
+        def on_result_observed(job, response_data, response_json):
+            self.observe(job, response_data)
+            on_result(job, response_data, response_json)
+        return on_result_observed
+
+    def seed(self, journal, table="output", column="Diagnosis"):
+        # Repetitions finished by earlier runs, from their rows in the journal (in rank order)
+        for record in journal.records():
+            diagnoses = None
+            if record["success"]:
+                diagnoses = [row.get(column) for row in record["tables"].get(table, [])]
+            self._observe(self._unit(record["case_no"], record.get("model")), record["repetition"], diagnoses)
+        return self
+
+    def start(self, jobs):
+        self._units.update(self._unit(job.case_no, job.model) for job in jobs)
+
+    def agreement(self, unit):
+        # Mean pairwise top_k overlap of the last `window` successful repetitions (None: too few)
+        repetitions = self._diagnoses.get(unit, {})
+        latest = [set(repetitions[repetition]) for repetition in sorted(repetitions)[-self.window:]]
+        if len(latest) < self.window:
+            return None
+        overlaps = [len(a & b) / max(len(a), len(b), 1) for a, b in itertools.combinations(latest, 2)]
+        return sum(overlaps) / len(overlaps)
+
+    def stable(self, unit):
+        agreement = self.agreement(unit)
+        return agreement is not None and agreement >= self.min_agreement
+
+    def budget(self):
+        return None if self.fixed_repetitions is None else len(self._units) * self.fixed_repetitions
+
+    def spent(self):
+        return sum(len(repetitions) for repetitions in self._attempted.values())
+
+    def select(self, jobs):
+        # The jobs of the next repetition worth requesting, in their original order
+        required, contested = [], []
+        for job in jobs:
+            unit = self._unit(job.case_no, job.model)
+            succeeded = len(self._diagnoses.get(unit, {}))
+            if succeeded < self.min_repetitions:
+                required.append(job)
+            elif succeeded < self.max_repetitions and not self.stable(unit):
+                contested.append(job)
+        budget = self.budget()
+        if budget is not None:
+            room = max(budget - self.spent() - len(required), 0)
+            contested.sort(key=lambda job: self.agreement(self._unit(job.case_no, job.model)) or 0.0)
+            contested = contested[:room]
+        chosen = set(required + contested)
+        return [job for job in jobs if job in chosen]
+
+    def stats(self):
+        repetitions = [len(self._diagnoses.get(unit, {})) for unit in self._units]
+        fixed = len(self._units) * self.fixed_repetitions if self.fixed_repetitions is not None else None
+        return {
+            "cases": len(self._units),
+            "jobs": self.spent(),
+            "fixed_schedule_jobs": fixed,
+            "saved_jobs": fixed - self.spent() if fixed is not None else None,
+            "stable_cases": sum(self.stable(unit) for unit in self._units),
+            "at_max_repetitions": sum(count >= self.max_repetitions for count in repetitions),
+            "mean_repetitions": sum(repetitions) / len(repetitions) if repetitions else 0.0,
+        }
@@ -0,0 +1,132 @@
+import os
+import re
+import types
+
+import openai
+
+# Chat-completions backends. run_jobs sends each request to the backend of its model (see
+# run_jobs' backends), so one run can compare models served by different endpoints. A backend
+# has create(request) for the serial path, create_async(request) for the async path and
+# aclose() to release what the async path opened; both return a ChatCompletion-shaped object,
+# or the chunk stream when the request has stream=True.
+
+
+class OpenAIBackend:
+    # Any OpenAI-compatible endpoint: the OpenAI API, a local server (vLLM, Ollama, the mock in
+    # benchmarks/mock_server.py) given its base_url. Without api_key and base_url it follows the
+    # openai module settings, as the scripts always did.
+
+    def __init__(self, api_key=None, base_url=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = None
+        self._async_client = None
+
+    def _settings(self):
+        return {"api_key": self.api_key or openai.api_key, "base_url": self.base_url or openai.base_url,
+                "max_retries": openai.max_retries}
+
+    def create(self, request):
+        if self.api_key is None and self.base_url is None:
+            return openai.chat.completions.create(**request)
+        if self._client is None:
+            self._client = openai.OpenAI(**self._settings())
+        return self._client.chat.completions.create(**request)
+
+    async def create_async(self, request):
+        # The async client belongs to the event loop of the run; aclose() drops it at the end
+        if self._async_client is None:
+            self._async_client = openai.AsyncOpenAI(**self._settings())
+        return await self._async_client.chat.completions.create(**request)
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+
+class _LocalStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        pass
+
+
+class _AsyncLocalStream(_LocalStream):
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        pass
+
+
+class LocalBackend:
+    # In-process stand-in: respond(request) returns the text of one completion (it is called once
+    # per choice). Usage counts characters / 4, enough for the metrics and cost columns.
+
+    def __init__(self, respond, chars_per_token=4):
+        self.respond = respond
+        self.chars_per_token = chars_per_token
+
+    def _usage(self, request, contents):
+        prompt_chars = sum(
+            len(message["content"]) if isinstance(message["content"], str)
+            else sum(len(part.get("text", "")) for part in message["content"])
+            for message in request.get("messages", [])
+        )
+        prompt_tokens = prompt_chars // self.chars_per_token
+        completion_tokens = sum(len(content) for content in contents) // self.chars_per_token
+        return types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                     total_tokens=prompt_tokens + completion_tokens,
+                                     prompt_tokens_details=types.SimpleNamespace(cached_tokens=0))
+
+    def _complete(self, request):
+        contents = [self.respond(request) for _ in range(request.get("n", 1))]
+        usage = self._usage(request, contents)
+        if not request.get("stream"):
+            return types.SimpleNamespace(
+                model=request.get("model"),
+                choices=[types.SimpleNamespace(index=i, message=types.SimpleNamespace(content=content),
+                                               finish_reason="stop")
+                         for i, content in enumerate(contents)],
+                usage=usage,
+            )
+        # The whole completion arrives as one chunk per choice
+        chunks = [
+            types.SimpleNamespace(
+                choices=[types.SimpleNamespace(index=i, delta=types.SimpleNamespace(content=content))], usage=None)
+            for i, content in enumerate(contents)
+        ]
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunks.append(types.SimpleNamespace(choices=[], usage=usage))
+        return chunks
+
+    def create(self, request):
+        response = self._complete(request)
+        return _LocalStream(response) if request.get("stream") else response
+
+    async def create_async(self, request):
+        response = self._complete(request)
+        return _AsyncLocalStream(response) if request.get("stream") else response
+
+    async def aclose(self):
+        pass
+
+
+def model_tag(model):
+    # The model name as a file name part ("meta-llama/Llama-3" -> "meta-llama-Llama-3")
+    return re.sub(r"[^A-Za-z0-9._-]+", "-", model)
+
+
+def model_outputs(path, models):
+    # [(model, output path)]: the path itself for a single-model run (model None, as its jobs
+    # carry no model), otherwise one <path>_<model> per model
+    if len(models) <= 1:
+        return [(None, path)]
+    base, ext = os.path.splitext(path)
+    return [(model, f"{base}_{model_tag(model)}{ext}") for model in models]
@@ -0,0 +1,132 @@
+import json
+import os
+import time
+
+import openai
+
+from pipeline.parsing import extract_response_data
+
+# Offline mode built on the Batch API file format: every job becomes one line of a JSONL
+# request file, the file is submitted and polled until the batch finishes, and the output
+# file is parsed back through the same JSON extraction as the interactive path.
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def custom_id(job):
+    return f"case-{job.case_no}-rep-{job.repetition}"
+
+
+def write_batch_file(path, jobs, build_request):
+    with open(path, "w", encoding="utf-8") as f:
+        for job in jobs:
+            line = {
+                "custom_id": custom_id(job),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_request(job),
+            }
+            f.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+
+
+class OpenAIBatchSubmitter:
+    # Submits through the Files and Batches endpoints. Pass a client created with a different
+    # base_url to run the same flow against a local stand-in server.
+    # Any object with the same submit/status/download methods can be used instead.
+
+    def __init__(self, client=None):
+        self.client = client or openai.OpenAI(api_key=openai.api_key, base_url=openai.base_url)
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {
+            "status": batch.status,
+            "completed": counts.completed if counts else 0,
+            "failed": counts.failed if counts else 0,
+            "total": counts.total if counts else 0,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+        }
+
+    def download(self, file_id):
+        return self.client.files.content(file_id).text
+
+
+def _parse_output_line(line, schema=None):
+    # Returns (custom_id, response_data, response_json, usage); response_data is None for failed
+    # lines and usage is the usage dict of the response body, if any
+    record = json.loads(line)
+    response = record.get("response") or {}
+    if record.get("error") or response.get("status_code") != 200:
+        body = response.get("body")
+        usage = body.get("usage") if isinstance(body, dict) else None
+        return record["custom_id"], None, json.dumps(record.get("error") or body, default=str), usage
+
+    choices = response["body"].get("choices") or []
+    response_json = (choices[0]["message"].get("content") or "") if choices else ""
+    usage = response["body"].get("usage")
+    try:
+        return record["custom_id"], extract_response_data(response_json, schema), response_json, usage
+    except Exception as e:
+        print(f"Error processing {record['custom_id']}: {str(e)}")
+        return record["custom_id"], None, response_json, usage
+
+
+def run_batch(jobs, build_request, submitter, batch_dir, name, poll_interval=60, schema=None, usage=None):
+    # Returns {job: (response_data, response_json)} for every job; when a usage dict is passed it
+    # is filled with {job: usage} for the lines that report token usage.
+    # The batch id is kept in <name>_batch.json so that a restarted run keeps polling the
+    # batch it already submitted instead of paying for a second one.
+    os.makedirs(batch_dir, exist_ok=True)
+    input_path = os.path.join(batch_dir, f"{name}_batch_input.jsonl")
+    state_path = os.path.join(batch_dir, f"{name}_batch.json")
+
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            batch_id = json.load(f)["batch_id"]
+        print(f"📦 Resuming batch {batch_id}")
+    else:
+        write_batch_file(input_path, jobs, build_request)
+        batch_id = submitter.submit(input_path)
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump({"batch_id": batch_id, "input_path": input_path}, f)
+        print(f"📦 Submitted batch {batch_id} with {len(jobs)} requests")
+
+    while True:
+        status = submitter.status(batch_id)
+        print(f"📦 Batch {batch_id}: {status['status']} "
+              f"({status['completed']}/{status['total']} completed, {status['failed']} failed)")
+        if status["status"] in TERMINAL_STATUSES:
+            break
+        time.sleep(poll_interval)
+
+    lines = []
+    for file_id in (status["output_file_id"], status["error_file_id"]):
+        if file_id:
+            lines.extend(line for line in submitter.download(file_id).splitlines() if line.strip())
+
+    results_by_id = {}
+    usage_by_id = {}
+    for line in lines:
+        line_id, response_data, response_json, line_usage = _parse_output_line(line, schema)
+        results_by_id[line_id] = (response_data, response_json)
+        usage_by_id[line_id] = line_usage
+
+    # The batch is finished; the next run submits a fresh batch for whatever is still missing
+    os.remove(state_path)
+
+    if usage is not None:
+        usage.update({job: usage_by_id[custom_id(job)] for job in jobs if usage_by_id.get(custom_id(job))})
+    missing = (None, f"No result in batch {batch_id} (status: {status['status']})")
+    return {job: results_by_id.get(custom_id(job), missing) for job in jobs}
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+
+class ResponseCache:
+    # Opt-in on-disk cache of raw response text, content-addressed by a SHA-256 of the request
+    # (model, messages including image references, temperature, max_tokens, seed) and the
+    # repetition index. Only responses that parsed successfully are stored. When the cache grows
+    # past max_bytes, the least recently used entries are evicted.
+    #
+    # share_deterministic_repetitions drops the repetition index from the key for temperature-0
+    # requests, so repetitions of a deterministic request are served from a single API call.
+
+    def __init__(self, directory, max_bytes=500 * 1024 * 1024, share_deterministic_repetitions=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.share_deterministic_repetitions = share_deterministic_repetitions
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._entries())
+
+    def _entries(self):
+        return [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".json")
+        ]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def key(self, request, repetition):
+        deterministic = request.get("temperature", 1.0) == 0.0
+        payload = {
+            "model": request.get("model"),
+            "messages": request.get("messages"),
+            "temperature": request.get("temperature"),
+            "max_tokens": request.get("max_tokens"),
+            "seed": request.get("seed"),
+            "n": request.get("n", 1),
+            "repetition": None if deterministic and self.share_deterministic_repetitions else repetition,
+        }
+        encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                response_json = json.load(f)["response"]
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        # Touch the entry so eviction is least-recently-used
+        os.utime(path)
+        self.hits += 1
+        return response_json
+
+    def put(self, key, response_json):
+        path = self._path(key)
+        if os.path.exists(path):
+            self._size -= os.path.getsize(path)
+        # Shard workers running side by side can share one cache directory
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"response": response_json}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        for path in sorted(self._entries(), key=os.path.getmtime):
+            if self._size <= self.max_bytes:
+                break
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size_bytes": self._size,
+        }
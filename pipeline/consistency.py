@@ -0,0 +1,148 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from pipeline.scoring import TOP_K, _normalized_codes, load_outputs
+
+# Consistency of the ranked differential diagnoses across repetitions and across conditions.
+# Every (condition, repetition, case) becomes one row of a code matrix holding its normalized
+# diagnoses in rank order. The lists are compared in pairs: all repetition pairs of a case within
+# a condition, and all repetition pairs of a case between two conditions. The metrics for every
+# pair are computed at once with array operations on the (pairs, depth, depth) match tensor:
+# - top-k overlap: share of the top k diagnoses found in both lists
+# - rank-biased overlap (Webber et al. 2010, extrapolated): overlap at every depth down to the
+#   longer list of the pair, weighted by p ** depth, so agreement at the top counts most
+# - Kendall tau over the diagnoses both lists contain: +1 same order, -1 reversed (NaN when
+#   fewer than two are shared)
+# Failed jobs (Error rows) are left out. benchmarks/check_consistency.py checks the metrics against a
+# plain per-pair loop.
+# Run: python -m pipeline.consistency PI=PI_output.xlsx PI+Text=PI+Text_output.xlsx ...
+
+RBO_P = 0.9
+_PAIR_CHUNK = 200_000
+
+
+def ranked_lists(output_df):
+    # (keys, codes): keys has Condition, Repetition, Case Number and Length (ranked entries) per
+    # list, codes the normalized diagnosis codes in rank order, -1 past the end of a list and for
+    # blank and repeated names
+    rank = pd.to_numeric(output_df["Rank"], errors="coerce")
+    df = output_df.assign(Rank=rank, **{"Case Number": output_df["Case Number"].astype(str)})
+    df = df[df["Rank"].notna()].sort_values(["Condition", "Repetition", "Case Number", "Rank"], kind="stable")
+    codes, names = _normalized_codes(df["Diagnosis"])
+    name_codes, distinct_names = pd.factorize(names)
+    name_codes = np.where(distinct_names[name_codes] == "", -1, name_codes)
+    codes = name_codes[codes] if len(codes) else codes
+
+    groups = df.groupby(["Condition", "Repetition", "Case Number"], sort=False)
+    list_index = groups.ngroup().to_numpy()
+    position = groups.cumcount().to_numpy()
+    depth = int(position.max()) + 1 if len(position) else 0
+    matrix = np.full((groups.ngroups, depth), -1, dtype=np.int64)
+    matrix[list_index, position] = codes
+
+    # A name repeated further down a list (after normalization) counts once, at its best rank
+    earlier = np.tril(np.ones((depth, depth), dtype=bool), -1)
+    repeated = ((matrix[:, :, None] == matrix[:, None, :]) & earlier).any(axis=2)
+    matrix[repeated] = -1
+    keys = groups.size().rename("Length").reset_index()[["Condition", "Repetition", "Case Number", "Length"]]
+    return keys, matrix
+
+
+def list_pairs(keys, conditions=None):
+    # Index pairs (left, right) into keys with the kind of comparison: the repetition pairs of a
+    # case within a condition, and every repetition pair of a case across two conditions
+    conditions = list(conditions or dict.fromkeys(keys["Condition"]))
+    order = {condition: i for i, condition in enumerate(conditions)}
+    indexed = keys.assign(List=np.arange(len(keys)), Order=keys["Condition"].map(order))
+    pairs = indexed.merge(indexed, on="Case Number", suffixes=(" A", " B"))
+    within = (pairs["Order A"] == pairs["Order B"]) & (pairs["Repetition A"] < pairs["Repetition B"])
+    across = pairs["Order A"] < pairs["Order B"]
+    pairs = pairs.assign(Comparison=np.where(within, "repetitions", "conditions"))
+    return pairs[within | across]
+
+
+def _pair_metrics(a, b, lengths, top_k, p):
+    # lengths: the depth of each pair, the longer of its two lists
+    valid = (a[:, :, None] >= 0) & (a[:, :, None] == b[:, None, :])
+    depth = a.shape[1]
+    metrics = {}
+    for k in top_k:
+        metrics[f"Overlap@{k}"] = valid[:, :k, :k].sum(axis=(1, 2)) / k
+
+    # Overlap X_d of the top d of both lists, for every depth d up to the pair's own depth, and
+    # the agreement X_d / d extrapolated from there
+    overlap = valid.cumsum(axis=1).cumsum(axis=2)[:, np.arange(depth), np.arange(depth)]
+    depths = np.arange(1, depth + 1)
+    agreement = overlap / depths
+    within = depths <= lengths[:, None]
+    metrics["RBO"] = ((1 - p) / p * (agreement * p ** depths * within).sum(axis=1)
+                      + agreement[np.arange(len(a)), lengths - 1] * p ** lengths.astype(float)
+                      if depth else np.full(len(a), np.nan))
+
+    # Position in b of each diagnosis of a (-1 when b lacks it)
+    position = np.where(valid.any(axis=2), valid.argmax(axis=2), -1)
+    later = np.triu(np.ones((depth, depth), dtype=bool), 1)
+    shared = (position[:, :, None] >= 0) & (position[:, None, :] >= 0) & later
+    concordant = (shared & (position[:, :, None] < position[:, None, :])).sum(axis=(1, 2))
+    discordant = shared.sum(axis=(1, 2)) - concordant
+    compared = concordant + discordant
+    with np.errstate(invalid="ignore", divide="ignore"):
+        metrics["Kendall Tau"] = np.where(compared > 0, (concordant - discordant) / compared, np.nan)
+    metrics["Shared"] = valid.sum(axis=(1, 2))
+    return metrics
+
+
+def pair_metrics(matrix, pairs, top_k=TOP_K, p=RBO_P):
+    # One row per pair with its metrics; chunks keep the match tensor small
+    left = pairs["List A"].to_numpy()
+    right = pairs["List B"].to_numpy()
+    lengths = np.maximum(pairs["Length A"].to_numpy(), pairs["Length B"].to_numpy()).astype(np.int64)
+    chunks = [
+        pd.DataFrame(_pair_metrics(matrix[left[start:start + _PAIR_CHUNK]], matrix[right[start:start + _PAIR_CHUNK]],
+                                   lengths[start:start + _PAIR_CHUNK], top_k, p))
+        for start in range(0, len(pairs), _PAIR_CHUNK)
+    ]
+    columns = [f"Overlap@{k}" for k in top_k] + ["RBO", "Kendall Tau", "Shared"]
+    metrics = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+    described = pairs[["Comparison", "Condition A", "Condition B", "Case Number", "Repetition A", "Repetition B"]]
+    return pd.concat([described.reset_index(drop=True), metrics[columns]], axis=1)
+
+
+def consistency(outputs, top_k=TOP_K, p=RBO_P):
+    # (pairs, summary): the metrics of every list pair, and their means per comparison
+    keys, matrix = ranked_lists(load_outputs(outputs))
+    pairs_df = pair_metrics(matrix, list_pairs(keys, outputs.keys()), top_k, p)
+    metric_columns = [f"Overlap@{k}" for k in top_k] + ["RBO", "Kendall Tau"]
+    grouped = pairs_df.groupby(["Comparison", "Condition A", "Condition B"], sort=False)
+    summary_df = grouped[metric_columns].mean()
+    summary_df.insert(0, "Cases", grouped["Case Number"].nunique())
+    summary_df.insert(0, "Pairs", grouped.size())
+    return pairs_df, summary_df.reset_index()
+
+
+def print_consistency(summary_df, top_k=TOP_K):
+    for row in summary_df.to_dict("records"):
+        label = (row["Condition A"] if row["Comparison"] == "repetitions"
+                 else f"{row['Condition A']} vs {row['Condition B']}")
+        overlaps = ", ".join(f"top-{k} overlap {row[f'Overlap@{k}']:.2f}" for k in top_k)
+        print(f"🔁 {label} ({row['Comparison']}, {row['Pairs']} pairs over {row['Cases']} cases): "
+              f"{overlaps}, RBO {row['RBO']:.2f}, Kendall tau {row['Kendall Tau']:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consistency of the ranked diagnoses across repetitions "
+                                                 "and conditions")
+    parser.add_argument("outputs", nargs="+", help="CONDITION=output.xlsx, its journal or result store")
+    parser.add_argument("--p", type=float, default=RBO_P, help="rank-biased overlap persistence")
+    parser.add_argument("--output", help="Excel file for the summary and the per-pair metrics")
+    args = parser.parse_args()
+
+    outputs = dict(output.split("=", 1) for output in args.outputs)
+    pairs_df, summary_df = consistency(outputs, p=args.p)
+    print_consistency(summary_df)
+    if args.output:
+        with pd.ExcelWriter(args.output) as writer:
+            summary_df.to_excel(writer, sheet_name="Summary", index=False)
+            pairs_df.to_excel(writer, sheet_name="Pairs", index=False)
@@ -0,0 +1,143 @@
+import datetime
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Dataset loading. The workbook is parsed with openpyxl once and stored as Parquet under the
+# SHA-256 of the workbook file, so the four conditions (and every rerun) read only the columns
+# they need from the columnar copy. Editing the workbook changes the hash and rebuilds the cache.
+# The case_image_links JSON map is validated and joined onto the cases in the same call.
+# Parquet needs one type per column, so an Excel column mixing numbers and text (e.g. case numbers
+# like 12 and "12a") is stored as JSON of each cell and decoded on load: cells keep the types
+# read_excel gives them, whether or not the cache was hit.
+
+HASH_CHUNK = 1 << 20
+# Part of the cache file name; bumped when the cache layout changes
+CACHE_VERSION = 2
+_JSON_COLUMNS = b"json_columns"
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _encode_cell(value):
+    # JSON of a cell; dates and times are tagged so they decode to the same type
+    if isinstance(value, datetime.datetime):
+        value = {"datetime": value.isoformat()}
+    elif isinstance(value, datetime.time):
+        value = {"time": value.isoformat()}
+    return json.dumps(value, default=str)
+
+
+def _decode_cell(text):
+    value = json.loads(text)
+    if isinstance(value, dict) and "datetime" in value:
+        return datetime.datetime.fromisoformat(value["datetime"])
+    if isinstance(value, dict) and "time" in value:
+        return datetime.time.fromisoformat(value["time"])
+    return value
+
+
+def _parquet_table(df):
+    # The workbook as an Arrow table, with the mixed-type columns as JSON cells
+    df = df.copy()
+    json_columns = []
+    for column in df.columns[df.dtypes == object]:
+        values = df[column].dropna()
+        if values.map(type).nunique() > 1:
+            df[column] = pd.Series([None if pd.isna(value) else _encode_cell(value) for value in df[column]],
+                                   index=df.index, dtype=object)
+            json_columns.append(column)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                          _JSON_COLUMNS: json.dumps(json_columns).encode()})
+
+
+def _read_cached(cache_path, columns):
+    df = pd.read_parquet(cache_path, columns=columns)
+    metadata = pq.ParquetFile(cache_path).schema_arrow.metadata or {}
+    for column in json.loads(metadata.get(_JSON_COLUMNS, b"[]")):
+        if column in df.columns:
+            df[column] = pd.Series([value if pd.isna(value) else _decode_cell(value) for value in df[column]],
+                                   index=df.index, dtype=object)
+    return df
+
+
+def cached_workbook(path, cache_dir):
+    # Path of the Parquet copy of the workbook, converting it first when there is none for the
+    # current file contents
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f"{stem}-{file_digest(path)[:16]}-v{CACHE_VERSION}.parquet")
+    if not os.path.exists(cache_path):
+        table = _parquet_table(pd.read_excel(path))
+        # Per-process temporary name; shard workers started together all convert the workbook
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, cache_path)
+        for stale in glob.glob(os.path.join(cache_dir, f"{glob.escape(stem)}-*.parquet")):
+            if stale != cache_path:
+                os.remove(stale)
+        print(f"🗃️ Cached {os.path.basename(path)} as {cache_path}")
+    return cache_path
+
+
+def load_image_links(path, case_numbers):
+    # Loads the {case number: [{"url": ...}, ...]} map and returns the image list of every case
+    with open(path, "r", encoding="utf-8") as f:
+        links = json.load(f)
+    if not isinstance(links, dict):
+        raise ValueError(f"{path}: expected an object mapping case numbers to image lists.")
+    for case_no, image_list in links.items():
+        if not isinstance(image_list, list) or not all(
+            isinstance(img, dict) and isinstance(img.get("url"), str) for img in image_list
+        ):
+            raise ValueError(f"{path}: images of case {case_no} must be a list of objects with a 'url'.")
+
+    keys = [str(case_no) for case_no in case_numbers]
+    missing = sum(1 for key in keys if not links.get(key))
+    unknown = len(set(links) - set(keys))
+    if missing or unknown:
+        print(f"⚠️ Image links: {missing} cases without images, {unknown} linked cases not in the dataset")
+    return [links.get(key, []) for key in keys]
+
+
+def load_dataset(path, columns, optional_columns=(), cache_dir="dataset_cache", image_links_path=None,
+                 case_column="Case_No"):
+    # Returns the requested columns of the workbook, plus the optional ones it has, and with
+    # image_links_path an "Image Links" column holding each case's image list
+    if pq is not None and cache_dir:
+        cache_path = cached_workbook(path, cache_dir)
+        available = pq.ParquetFile(cache_path).schema_arrow.names
+    else:
+        # No Parquet support: read the workbook directly, still only the needed columns
+        cache_path = None
+        available = pd.read_excel(path, nrows=0).columns.tolist()
+
+    missing = [column for column in columns if column not in available]
+    if missing:
+        raise ValueError(f"{path} is missing the columns {missing}.")
+    selected = list(columns) + [column for column in optional_columns if column in available]
+
+    if cache_path is not None:
+        df = _read_cached(cache_path, selected)
+    else:
+        df = pd.read_excel(path, usecols=selected)[selected]
+
+    if image_links_path is not None:
+        df["Image Links"] = load_image_links(image_links_path, df[case_column])
+    return df
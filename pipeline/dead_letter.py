@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from pipeline.dispatch import RUN_OPTIONS, Job
+from pipeline.rate_limit import classify_error
+
+# Dead-letter store. A job that still fails once its retries are used up is appended to
+# <output>_dead_letter.jsonl with the request that was sent, the last raw response and the error
+# class. Re-driving replays exactly those requests, with the run-wide options (streaming,
+# structured outputs) of the re-drive rather than those of the failed run; each success is
+# journalled like any other result, so the next export shows it in place of the Error row, and
+# its entry is resolved.
+# Show:     python -m pipeline.dead_letter show PI+Text_output_dead_letter.jsonl
+# Re-drive: python -m pipeline.dead_letter redrive PI+Text.py
+
+
+def _without_run_options(request):
+    return None if request is None else {key: value for key, value in request.items() if key not in RUN_OPTIONS}
+
+
+def describe_error(error):
+    return error if error is None or isinstance(error, str) else f"{type(error).__name__}: {error}"
+
+
+class DeadLetterStore:
+    # Append-only like the journal: every failure and every resolution is a line, and the latest
+    # line of a job decides whether it is still dead-lettered
+
+    def __init__(self, path, condition):
+        self.path = path
+        self.condition = condition
+        self._entries = {}
+        if os.path.exists(path):
+            self._load(path)
+
+    def _load(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get("condition") == self.condition:
+                    self._entries[self._entry_key(entry)] = entry
+
+    @staticmethod
+    def _key(job):
+        return str(job.case_no), job.repetition, job.model
+
+    @staticmethod
+    def _entry_key(entry):
+        return str(entry["case_no"]), entry["repetition"], entry.get("model")
+
+    def _append(self, entries):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for entry in entries:
+            self._entries[self._entry_key(entry)] = entry
+
+    def add(self, job, request, response_json, error):
+        # error is the exception of the last attempt, or a message (batch lines)
+        self._append([{
+            "condition": self.condition,
+            "status": "failed",
+            "case_no": job.case_no,
+            "case_index": job.case_index,
+            "repetition": job.repetition,
+            "model": job.model,
+            "failed_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "error_class": type(error).__name__ if not isinstance(error, str) else "BatchLineError",
+            "error_category": classify_error(error) if not isinstance(error, str) else None,
+            "error": describe_error(error),
+            "response": response_json,
+            "request": _without_run_options(request),
+        }])
+
+    def resolve(self, job):
+        entry = self._entries.get(self._key(job))
+        if entry is not None and entry["status"] == "failed":
+            self._append([dict(entry, status="resolved", resolved_at=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                               request=None)])
+
+    def pending(self):
+        return [entry for entry in self._entries.values() if entry["status"] == "failed"]
+
+    def jobs(self):
+        return [Job(entry["repetition"], entry["case_index"], entry["case_no"], entry.get("model"))
+                for entry in sorted(self.pending(), key=lambda entry: (entry["repetition"], entry["case_index"]))]
+
+    def replay(self, build_request):
+        # Request builder returning the stored request of a dead-lettered job. Fanned-out jobs are
+        # built without their model (see run_jobs), so any model's entry of the case stands in.
+        requests = {}
+        for entry in self.pending():
+            case_no, repetition, model = self._entry_key(entry)
+            # Entries stored with the options of their run get those of this one
+            request = _without_run_options(entry["request"])
+            requests[(case_no, repetition, model)] = request
+            requests.setdefault((case_no, repetition, None), request)
+
+        def build_stored_request(job):
+            request = requests.get(self._key(job))
+            return request if request is not None else build_request(job)
+        return build_stored_request
+
+    def merge(self, paths):
+        # Folds other stores of this condition (e.g. the shards' stores) into this one
+        existing = dict(self._entries)
+        entries = []
+        for path in paths:
+            if os.path.exists(path):
+                entries.extend(DeadLetterStore(path, self.condition)._entries.values())
+        self._append([entry for entry in entries if existing.get(self._entry_key(entry)) != entry])
+
+    def summary(self):
+        counts = {}
+        for entry in self.pending():
+            counts[entry["error_class"]] = counts.get(entry["error_class"], 0) + 1
+        return counts
+
+
+def show(path, condition=None):
+    conditions = condition and [condition]
+    if conditions is None:
+        with open(path, "r", encoding="utf-8") as f:
+            conditions = list(dict.fromkeys(json.loads(line)["condition"] for line in f if line.strip()))
+    for name in conditions:
+        store = DeadLetterStore(path, name)
+        pending = store.pending()
+        classes = ", ".join(f"{count} {error_class}" for error_class, count in store.summary().items())
+        print(f"📮 {name}: {len(pending)} dead-lettered jobs{f' ({classes})' if classes else ''}")
+        for entry in sorted(pending, key=lambda entry: (entry["repetition"], entry["case_index"])):
+            model = f" {entry['model']}" if entry.get("model") else ""
+            print(f"   case {entry['case_no']} rep {entry['repetition']}{model}: {str(entry['error'])[:100]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and re-drive dead-lettered jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    show_parser = commands.add_parser("show", help="list the dead-lettered jobs of a store")
+    show_parser.add_argument("path", help="<output>_dead_letter.jsonl")
+    show_parser.add_argument("--condition")
+    redrive_parser = commands.add_parser("redrive", help="replay the dead-lettered jobs of a condition script")
+    redrive_parser.add_argument("script", help="condition script, e.g. PI+Text.py")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        show(args.path, args.condition)
+    else:
+        env = dict(os.environ, REDRIVE_DEAD_LETTERS="1")
+        sys.exit(subprocess.run([sys.executable, args.script], env=env).returncode)
@@ -0,0 +1,575 @@
+import asyncio
+import time
+from collections import namedtuple
+
+from pipeline.backends import OpenAIBackend, model_tag
+from pipeline.batch import OpenAIBatchSubmitter, run_batch
+from pipeline.parsing import extract_response_data, response_text
+from pipeline.metrics import RequestMetrics, print_summary, summarize, write_metrics
+from pipeline.rate_limit import FAIL, RESAMPLE, RateLimiter, classify_error
+from pipeline.schemas import response_format
+from pipeline.streaming import MAX_PREAMBLE_CHARS, StreamMonitor
+
+# One unit of work: a single case in a single repetition, for a single model when the run fans
+# out to several (model None sends the request's own model)
+Job = namedtuple("Job", ["repetition", "case_index", "case_no", "model"], defaults=[None])
+# Request keys run_jobs sets for the whole run (see _with_options)
+RUN_OPTIONS = ("response_format", "stream", "stream_options")
+
+
+def make_jobs(case_no_list, num_repetition):
+    # Repetition-major order, the same order as the original nested loops
+    return [
+        Job(r, i, case_no)
+        for r in range(num_repetition)
+        for i, case_no in enumerate(case_no_list)
+    ]
+
+
+def fan_out(jobs, models):
+    # One job per model for every job; the models of a job are adjacent so the request built for
+    # the first is reused for the others
+    if len(models) <= 1:
+        return list(jobs)
+    return [job._replace(model=model) for job in jobs for model in models]
+
+
+class NSampling:
+    # Collapses the repetitions of a case into one request with n choices. Every choice is
+    # parsed on its own; choices that fail to parse, and all repetitions once the endpoint
+    # rejects n > 1, fall back to separate requests.
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.requests = 0
+        self.repetitions_served = 0
+        self.fallbacks = 0
+        self.choice_parse_failures = 0
+
+    def units(self, jobs):
+        # Jobs sent together: all pending repetitions of a case, or one job each
+        if not self.enabled:
+            return [[job] for job in jobs]
+        units = {}
+        for job in jobs:
+            units.setdefault((job.case_index, job.model), []).append(job)
+        return list(units.values())
+
+    def parser(self, pending, schema=None):
+        def parse(response):
+            choices = sorted(response.choices, key=lambda choice: choice.index)
+            results = {}
+            for job, choice in zip(pending, choices):
+                response_json = choice.message.content or ""
+                try:
+                    results[job] = (extract_response_data(response_json, schema), response_json)
+                except Exception as e:
+                    self.choice_parse_failures += 1
+                    print(f"Error processing {job.case_no} (choice {choice.index}): {str(e)}")
+            return results, len(choices)
+        return parse
+
+    def record(self, outcome, error, pending):
+        self.requests += 1
+        results, num_choices = outcome if outcome is not None else ({}, 0)
+        if (outcome is None and error is not None and classify_error(error) == FAIL) or num_choices == 1:
+            print(f"⚠️ n-sampling unavailable ({str(error) if error else 'single choice returned'}), "
+                  f"falling back to separate requests")
+            self.enabled = False
+        self.repetitions_served += len(results)
+        self.fallbacks += len(pending) - len(results)
+        return results
+
+    def stats(self):
+        return {
+            "n_requests": self.requests,
+            "repetitions_served": self.repetitions_served,
+            "fallback_requests": self.fallbacks,
+            "choice_parse_failures": self.choice_parse_failures,
+        }
+
+
+def _log_retry(job, error, retries, max_retries):
+    print(f"Error processing {job.case_no}: {str(error)}")
+    print(f"Retrying {retries}/{max_retries}...")
+
+
+def _single_parser(schema=None):
+    def parse(response):
+        return extract_response_data(response_text(response), schema)
+    return parse
+
+
+def _keep_text(last_response, response):
+    # last_response[0] keeps the raw text of the latest attempt that returned any, for the journal
+    # and the Error row
+    if last_response is not None and response is not None:
+        try:
+            last_response[0] = response_text(response)
+        except ValueError:
+            pass
+
+
+def _cache_lookup(cache, unit, request, schema=None):
+    # Returns (results for cache hits, jobs still pending, cache keys of the pending jobs)
+    if cache is None:
+        return {}, list(unit), {}
+    results, pending, keys = {}, [], {}
+    for job in unit:
+        key = cache.key(request, job.repetition)
+        response_json = cache.get(key)
+        try:
+            if response_json is not None:
+                results[job] = (extract_response_data(response_json, schema), response_json)
+                continue
+        except ValueError:
+            # Cached before the current schema was in force; fetch a fresh response
+            pass
+        pending.append(job)
+        keys[job] = key
+    return results, pending, keys
+
+
+def _cache_store(cache, keys, results):
+    for job, key in keys.items():
+        response_data, response_json = results[job]
+        if response_data is not None:
+            cache.put(key, response_json)
+
+
+class _Run:
+    # Settings and shared state of one run_jobs call
+    def __init__(self, max_retries, limiter, cache, n_sampling, stream_monitor, schema, metrics, backends,
+                 dead_letters, hedging):
+        self.max_retries = max_retries
+        self.limiter = limiter
+        self.cache = cache
+        self.n_sampling = n_sampling
+        self.stream_monitor = stream_monitor
+        self.schema = schema
+        self.metrics = metrics
+        self.backends = backends
+        self.dead_letters = dead_letters
+        self.hedging = hedging
+        self.default_backend = OpenAIBackend()
+        self.semaphore = None
+        self.attempts = 0
+        self.parse_failures = 0
+        self.retried_calls = 0
+        self.calls = 0
+
+    def backend(self, request):
+        return self.backends.get(request["model"], self.default_backend)
+
+    async def close_backends(self):
+        for backend in {id(backend): backend for backend in [self.default_backend, *self.backends.values()]}.values():
+            await backend.aclose()
+
+    def job_failed(self, job, request, response_json, error):
+        # A job out of attempts: its Error row gets the last raw response of that job, or the error
+        # itself when none came back, and the dead-letter store keeps the request for a re-drive
+        if self.dead_letters is not None:
+            self.dead_letters.add(job, request, response_json, error)
+        if response_json or error is None:
+            return response_json
+        return error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+
+    def deliver(self, on_result, job, result):
+        on_result(job, *result)
+        if result[0] is not None and self.dead_letters is not None:
+            self.dead_letters.resolve(job)
+
+    def attempt_failed(self, error, attempt):
+        if classify_error(error) == RESAMPLE:
+            self.parse_failures += 1
+        if attempt == 1:
+            self.retried_calls += 1
+
+    def parse_stats(self):
+        parse_failures = self.parse_failures + self.n_sampling.choice_parse_failures
+        return {
+            "calls": self.calls,
+            "attempts": self.attempts,
+            "parse_failures": parse_failures,
+            "parse_failure_rate": parse_failures / self.attempts if self.attempts else 0.0,
+            "retry_rate": self.retried_calls / self.calls if self.calls else 0.0,
+        }
+
+
+def _attempt_serial(run, request, parse, received):
+    # One API call and the parsing of its response. Only a response that fails to parse is kept,
+    # in received[0], so its usage and text are still recorded; a hedged copy that loses (and may
+    # still be running) cannot overwrite the response of the copy that won.
+    def attempt():
+        response = None
+        try:
+            response = run.backend(request).create(request)
+            if request.get("stream"):
+                response = run.stream_monitor.collect(response, request)
+            return response, parse(response)
+        except Exception:
+            if response is not None:
+                received[0] = response
+            raise
+    return attempt
+
+
+def _call_serial(run, job, request, parse, last_response=None):
+    # Returns (parse(response), None), or (None, last error) once the attempts are used up
+    error = None
+    run.calls += 1
+    for attempt in range(1, run.max_retries + 1):
+        time.sleep(run.limiter.acquire(request))
+        run.attempts += 1
+        received, started = [None], time.time()
+        try:
+            attempt_call = _attempt_serial(run, request, parse, received)
+            if run.hedging is not None:
+                response, outcome = run.hedging.call(request, attempt_call, lambda: run.limiter.acquire(request))
+            else:
+                response, outcome = attempt_call()
+            run.metrics.record(job, request, attempt, started, getattr(response, "usage", None))
+            _keep_text(last_response, response)
+            return outcome, None
+        except Exception as e:
+            error = e
+            run.metrics.record(job, request, attempt, started, getattr(received[0], "usage", None), e)
+            _keep_text(last_response, received[0])
+            run.attempt_failed(e, attempt)
+            _log_retry(job, e, attempt, run.max_retries)
+            delay = run.limiter.backoff(e, attempt)
+            if delay is None:
+                break
+            time.sleep(delay)
+    return None, error
+
+
+def _request_serial(run, unit, request):
+    results, pending, keys = _cache_lookup(run.cache, unit, request, run.schema)
+
+    if len(pending) > 1 and run.n_sampling.enabled:
+        n_request = dict(request, n=len(pending))
+        outcome, error = _call_serial(run, pending[0], n_request, run.n_sampling.parser(pending, run.schema))
+        results.update(run.n_sampling.record(outcome, error, pending))
+
+    for job in pending:
+        if job not in results:
+            last_response = [""]
+            response_data, error = _call_serial(run, job, request, _single_parser(run.schema), last_response)
+            if response_data is None:
+                last_response[0] = run.job_failed(job, request, last_response[0], error)
+            results[job] = (response_data, last_response[0])
+
+    _cache_store(run.cache, keys, results)
+    return results
+
+
+def _run_serial(run, units, build_request, on_result):
+    for unit in units:
+        results = _request_serial(run, unit, build_request(unit[0]))
+        for job in unit:
+            run.deliver(on_result, job, results[job])
+
+
+def _attempt_async(run, request, parse, received):
+    async def attempt():
+        response = None
+        try:
+            response = await run.backend(request).create_async(request)
+            if request.get("stream"):
+                response = await run.stream_monitor.collect_async(response, request)
+            return response, parse(response)
+        except Exception:
+            if response is not None:
+                received[0] = response
+            raise
+    return attempt
+
+
+async def _call_async(run, job, request, parse, last_response=None):
+    error = None
+    run.calls += 1
+    for attempt in range(1, run.max_retries + 1):
+        await asyncio.sleep(run.limiter.acquire(request))
+        run.attempts += 1
+        received, started = [None], time.time()
+        try:
+            # Only the API call holds a slot, so backing off does not block other jobs
+            async with run.semaphore:
+                started = time.time()
+                attempt_call = _attempt_async(run, request, parse, received)
+                if run.hedging is not None:
+                    response, outcome = await run.hedging.call_async(request, attempt_call,
+                                                                     lambda: run.limiter.acquire(request))
+                else:
+                    response, outcome = await attempt_call()
+            run.metrics.record(job, request, attempt, started, getattr(response, "usage", None))
+            _keep_text(last_response, response)
+            return outcome, None
+        except Exception as e:
+            error = e
+            run.metrics.record(job, request, attempt, started, getattr(received[0], "usage", None), e)
+            _keep_text(last_response, received[0])
+            run.attempt_failed(e, attempt)
+            _log_retry(job, e, attempt, run.max_retries)
+            delay = run.limiter.backoff(e, attempt)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+    return None, error
+
+
+async def _request_async(run, unit, request):
+    results, pending, keys = _cache_lookup(run.cache, unit, request, run.schema)
+
+    if len(pending) > 1 and run.n_sampling.enabled:
+        n_request = dict(request, n=len(pending))
+        outcome, error = await _call_async(run, pending[0], n_request, run.n_sampling.parser(pending, run.schema))
+        results.update(run.n_sampling.record(outcome, error, pending))
+
+    for job in pending:
+        if job not in results:
+            last_response = [""]
+            response_data, error = await _call_async(run, job, request, _single_parser(run.schema), last_response)
+            if response_data is None:
+                last_response[0] = run.job_failed(job, request, last_response[0], error)
+            results[job] = (response_data, last_response[0])
+
+    _cache_store(run.cache, keys, results)
+    return results
+
+
+async def _run_async(run, units, build_request, on_result, max_concurrency):
+    run.semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = [asyncio.create_task(_request_async(run, unit, build_request(unit[0]))) for unit in units]
+    try:
+        # Hand results back in job order so the output is identical to the serial path
+        for unit, task in zip(units, tasks):
+            results = await task
+            for job in unit:
+                run.deliver(on_result, job, results[job])
+    finally:
+        for task in tasks:
+            task.cancel()
+        await run.close_backends()
+
+
+def _per_model(build_request):
+    # Fanned-out jobs of a case and repetition differ only in their model, so the request (prompt,
+    # images) is built once for the first of them and only the model is swapped for the others
+    last = [None, None]
+
+    def build_request_for_model(job):
+        if job.model is None:
+            return build_request(job)
+        shared = job._replace(model=None)
+        if last[0] != shared:
+            last[0], last[1] = shared, build_request(shared)
+        return dict(last[1], model=job.model)
+    return build_request_for_model
+
+
+def _with_options(build_request, options):
+    # Adds run-wide request options (RUN_OPTIONS: response format, streaming) to every request
+    if not options:
+        return build_request
+
+    def build_request_with_options(job):
+        return dict(build_request(job), **options)
+    return build_request_with_options
+
+
+def _run_batch(run, jobs, build_request, batch_submitter, batch_dir, batch_name, batch_poll_interval):
+    # The results of one batch file; run_jobs delivers them once every model's batch is in
+    requests = {job: build_request(job) for job in jobs}
+    results = {}
+    keys = {}
+    for job in jobs:
+        hits, _, job_keys = _cache_lookup(run.cache, [job], requests[job], run.schema)
+        results.update(hits)
+        keys.update(job_keys)
+    pending = [job for job in jobs if job not in results]
+
+    if pending:
+        usage = {}
+        batch_results = run_batch(pending, requests.__getitem__, batch_submitter or OpenAIBatchSubmitter(),
+                                  batch_dir, batch_name, batch_poll_interval, run.schema, usage)
+        run.calls += len(pending)
+        run.attempts += len(pending)
+        run.parse_failures += sum(response_data is None for response_data, _ in batch_results.values())
+        for job in pending:
+            response_data, response_json = batch_results[job]
+            failed = response_data is None
+            run.metrics.record(job, requests[job], 1, None, usage.get(job), response_json if failed else None,
+                               outcome="failed" if failed else None)
+            if failed:
+                run.job_failed(job, requests[job], response_json, response_json)
+        results.update(batch_results)
+        _cache_store(run.cache, keys, results)
+    return results
+
+
+def _rounds(jobs, adaptive):
+    # All jobs at once, or with adaptive repetitions one repetition at a time, each chosen once
+    # the results of the previous ones are in
+    if adaptive is None:
+        yield jobs
+        return
+    for repetition in sorted({job.repetition for job in jobs}):
+        round_jobs = adaptive.select([job for job in jobs if job.repetition == repetition])
+        if round_jobs:
+            yield round_jobs
+
+
+def run_jobs(jobs, build_request, on_result, mode="serial", max_concurrency=8, max_retries=5, rate_limiter=None,
+             cache=None, batch_submitter=None, batch_dir="batches", batch_poll_interval=60, sample_with_n=False,
+             stream=False, stream_max_preamble=MAX_PREAMBLE_CHARS, response_schema=None, condition="run",
+             metrics_path=None, backends=None, dead_letters=None, adaptive=None, hedging=None):
+    # build_request(job) returns the keyword arguments for chat.completions.create
+    # on_result(job, response_data, response_json) is called once per job, in job order;
+    # response_data is None when the job failed after max_retries attempts
+    # rate_limiter is a pipeline.rate_limit.RateLimiter shared by all requests of the run
+    # cache is an optional pipeline.cache.ResponseCache consulted before every API call
+    # mode "batch" submits all jobs as one Batch API file per model (see pipeline.batch); failed lines
+    # are not retried within the run. batch_submitter replaces the OpenAI submit/poll step.
+    # sample_with_n requests all pending repetitions of a case as n choices of one completion
+    # (serial and async modes); on_result then receives the repetitions of a case together,
+    # case by case, instead of repetition by repetition
+    # stream reads responses token by token (serial and async modes), records time to first token
+    # and drops a response early once it cannot yield a differential_diagnoses array;
+    # stream_max_preamble is how much text may come before the JSON object (None: no limit)
+    # response_schema (see pipeline.schemas) requests structured outputs with that JSON schema and
+    # validates every parsed response against it
+    # condition names the batch files and labels the parse-failure report and the metrics
+    # metrics_path, when given, accumulates the per-request metrics of every run and their summary
+    # (see pipeline.metrics)
+    # backends maps a model name to the pipeline.backends backend serving it; other models use the
+    # OpenAI API. Jobs from fan_out carry a model, which replaces the request's own.
+    # dead_letters (a pipeline.dead_letter.DeadLetterStore) records every job that fails after its
+    # retries with the request sent, and resolves the entry once the job succeeds
+    # adaptive (a pipeline.adaptive.AdaptiveSampling) runs the jobs repetition by repetition and
+    # skips the later repetitions of cases whose diagnoses have converged; jobs then holds every
+    # repetition up to its max_repetitions. Repetitions are no longer sent together as n choices.
+    # hedging (a pipeline.hedging.HedgingPolicy) sends a second copy of a call that is slower than
+    # the policy's latency percentile and keeps the first valid response (serial and async modes)
+    limiter = rate_limiter or RateLimiter()
+    n_sampling = NSampling(sample_with_n and mode != "batch")
+    stream_monitor = StreamMonitor(stream_max_preamble) if stream and mode != "batch" else None
+    run = _Run(max_retries, limiter, cache, n_sampling, stream_monitor, response_schema, RequestMetrics(condition),
+               backends or {}, dead_letters, hedging if mode != "batch" else None)
+    if adaptive is not None:
+        adaptive.start(jobs)
+        on_result = adaptive.observing(on_result)
+    build_request = _per_model(build_request)
+
+    options = {}
+    if response_schema is not None:
+        options["response_format"] = response_format(response_schema)
+    batch_request_builder = _with_options(build_request, options)
+    if stream_monitor is not None:
+        options.update(stream=True, stream_options={"include_usage": True})
+    request_builder = _with_options(build_request, options)
+
+    if mode not in ("serial", "async", "batch"):
+        raise ValueError(f"Unknown execution mode: {mode}")
+    start = time.perf_counter()
+    num_jobs = 0
+    for round_jobs in _rounds(jobs, adaptive):
+        num_jobs += len(round_jobs)
+        units = n_sampling.units(round_jobs)
+        if mode == "serial":
+            _run_serial(run, units, request_builder, on_result)
+        elif mode == "async":
+            asyncio.run(_run_async(run, units, request_builder, on_result, max_concurrency))
+        else:
+            # A batch file holds the requests of a single model; the results of all models are
+            # delivered together, in job order
+            results = {}
+            for model in dict.fromkeys(job.model for job in round_jobs):
+                model_jobs = [job for job in round_jobs if job.model == model]
+                batch_name = condition if model is None else f"{condition}_{model_tag(model)}"
+                results.update(_run_batch(run, model_jobs, batch_request_builder, batch_submitter, batch_dir,
+                                          batch_name, batch_poll_interval))
+            for job in round_jobs:
+                run.deliver(on_result, job, results[job])
+    elapsed = time.perf_counter() - start
+    if run.hedging is not None:
+        # Copies that lost are charged once they finish
+        run.hedging.finish()
+
+    throughput = num_jobs / elapsed if elapsed > 0 else 0.0
+    concurrency = {"async": max_concurrency, "batch": num_jobs}.get(mode, 1)
+    print(f"\n⏱️ {mode} run (concurrency {concurrency}): {num_jobs} jobs in {elapsed:.1f}s "
+          f"({throughput:.2f} jobs/s)")
+    limiter_stats = limiter.stats()
+    print(f"🚦 Rate limiter: throttled {limiter_stats['throttled_s']:.1f}s over "
+          f"{limiter_stats['throttled_requests']} requests, backed off {limiter_stats['backoff_s']:.1f}s "
+          f"({limiter_stats['rate_limit_errors']} rate-limit, {limiter_stats['transient_errors']} transient, "
+          f"{limiter_stats['output_errors']} output, {limiter_stats['fatal_errors']} fatal errors)")
+    if cache is not None:
+        cache_stats = cache.stats()
+        print(f"🗄️ Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+              f"{cache_stats['evictions']} evictions")
+    if stream_monitor is not None:
+        stream_stats = stream_monitor.stats()
+        ttft = f"{stream_stats['ttft_p50_s']:.2f}s" if stream_stats["ttft_p50_s"] is not None else "n/a"
+        print(f"📡 Streaming: median time to first token {ttft}, "
+              f"{stream_stats['early_aborts']} of {stream_stats['streams']} streams aborted early")
+    prompt_cache = run.metrics.prompt_cache_stats()
+    if prompt_cache["prompt_tokens"]:
+        latency = " vs ".join(
+            f"{prompt_cache[key]:.2f}s {label}" for key, label in
+            (("mean_latency_cached_s", "with"), ("mean_latency_uncached_s", "without"))
+            if prompt_cache[key] is not None
+        )
+        print(f"💾 Prompt cache: {prompt_cache['cached_tokens']:,} of {prompt_cache['prompt_tokens']:,} "
+              f"prompt tokens cached ({prompt_cache['cached_rate']:.1%}), saving ${prompt_cache['cache_savings_usd']:.2f}; "
+              f"mean latency {latency or 'n/a'} cached tokens")
+    parse_stats = run.parse_stats()
+    print(f"🧩 {condition} (structured outputs {'on' if response_schema is not None else 'off'}): "
+          f"{parse_stats['parse_failures']} parse failures in {parse_stats['attempts']} attempts "
+          f"({parse_stats['parse_failure_rate']:.1%}), {parse_stats['retry_rate']:.1%} of requests retried")
+    if sample_with_n:
+        n_stats = n_sampling.stats()
+        print(f"🎲 n-sampling: {n_stats['n_requests']} requests served {n_stats['repetitions_served']} repetitions, "
+              f"{n_stats['fallback_requests']} repetitions fell back to separate requests")
+    if run.hedging is not None:
+        hedge_stats = hedging.stats()
+        print(f"🪁 Hedging: {hedge_stats['hedged']} of {hedge_stats['calls']} calls hedged "
+              f"({hedge_stats['hedge_rate']:.1%}), the copy won {hedge_stats['hedge_wins']}; "
+              f"{hedge_stats['extra_prompt_tokens']:,} prompt / {hedge_stats['extra_completion_tokens']:,} "
+              f"completion tokens extra, est. ${hedge_stats['extra_cost_usd']:.2f}")
+    if adaptive is not None:
+        adaptive_stats = adaptive.stats()
+        saved = ""
+        if adaptive_stats["fixed_schedule_jobs"] is not None:
+            saved = (f" of {adaptive_stats['fixed_schedule_jobs']} on the fixed schedule "
+                     f"({adaptive_stats['saved_jobs']} saved)")
+        print(f"🪜 Adaptive repetitions: {adaptive_stats['jobs']} jobs{saved}, "
+              f"{adaptive_stats['mean_repetitions']:.1f} repetitions per case on average; "
+              f"{adaptive_stats['stable_cases']} of {adaptive_stats['cases']} cases stable, "
+              f"{adaptive_stats['at_max_repetitions']} reached max_repetitions")
+    if dead_letters is not None and dead_letters.pending():
+        classes = ", ".join(f"{count} {error_class}" for error_class, count in dead_letters.summary().items())
+        print(f"📮 Dead letters: {len(dead_letters.pending())} failed jobs ({classes}) in {dead_letters.path}")
+    metrics_df = run.metrics.to_frame()
+    metrics_summary = summarize(metrics_df)
+    print_summary(metrics_summary)
+    if metrics_path is not None and len(metrics_df):
+        # Merged into the rows of earlier runs; a run without attempts leaves the workbook as it is
+        write_metrics(metrics_path, metrics_df)
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": num_jobs,
+        "wall_clock_s": elapsed,
+        "requests_per_s": throughput,
+        "rate_limiter": limiter_stats,
+        "n_sampling": n_sampling.stats(),
+        "streaming": stream_monitor.stats() if stream_monitor is not None else None,
+        "parsing": parse_stats,
+        "prompt_cache": prompt_cache,
+        "metrics": metrics_summary,
+        "adaptive": adaptive.stats() if adaptive is not None else None,
+        "hedging": run.hedging.stats() if run.hedging is not None else None,
+    }
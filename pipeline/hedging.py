@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+from pipeline.metrics import request_cost
+from pipeline.prompts import usage_tokens
+
+# Hedged requests. The latency of recent successful calls is tracked per model; once a call has
+# been outstanding for longer than the given percentile of them, the same request is sent again
+# and whichever copy first returns a response that parses wins. In async mode the other copy is
+# cancelled. A synchronous call cannot be interrupted, so in serial mode the losing copy finishes
+# in the background and its result is dropped. Tokens a losing copy used are counted as the price
+# of hedging: its usage when it finished, or the winner's prompt tokens when it was cancelled
+# (providers bill the prompt once processing has started).
+
+
+class HedgingPolicy:
+
+    def __init__(self, percentile=95, window=200, min_samples=20, min_delay=1.0):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._latencies = {}
+        self._pool = None
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.extra_prompt_tokens = 0
+        self.extra_completion_tokens = 0
+        self.extra_cost = 0.0
+
+    def delay(self, model):
+        # Seconds to wait before hedging a call to model (None until enough calls were seen)
+        latencies = self._latencies.get(model)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def observe(self, model, latency):
+        self._latencies.setdefault(model, collections.deque(maxlen=self.window)).append(latency)
+
+    def _charge(self, model, usage):
+        prompt, _, completion = usage_tokens(usage)
+        self.extra_prompt_tokens += prompt
+        self.extra_completion_tokens += completion
+        self.extra_cost += request_cost(model, prompt, 0, completion)
+
+    def _charge_loser(self, model, loser, winner_response):
+        # loser is the future of the other copy, once it is done or cancelled; a copy that failed
+        # raised before its usage reached us
+        if loser.cancelled():
+            prompt = usage_tokens(getattr(winner_response, "usage", None))[0]
+            self.extra_prompt_tokens += prompt
+            self.extra_cost += request_cost(model, prompt, 0, 0)
+        elif loser.exception() is None:
+            self._charge(model, getattr(loser.result()[0], "usage", None))
+
+    def _settle(self, model, started, winner, futures):
+        # The latency the caller saw, from when the call was first dispatched, whichever copy won
+        response, outcome = winner.result()
+        self.observe(model, time.perf_counter() - started)
+        if len(futures) > 1:
+            self.hedge_wins += winner is futures[1]
+        return response, outcome
+
+    def call(self, request, attempt, acquire):
+        # attempt() returns (response, parsed outcome) and raises when the response is unusable;
+        # acquire() reserves the rate limit for the copy and returns the seconds to wait first
+        model = request["model"]
+        self.calls += 1
+        delay = self.delay(model)
+        if delay is None:
+            started = time.perf_counter()
+            result = attempt()
+            self.observe(model, time.perf_counter() - started)
+            return result
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=32)
+        started = time.perf_counter()
+        futures = [self._pool.submit(attempt)]
+        done, _ = concurrent.futures.wait(futures, timeout=delay)
+        if not done:
+            time.sleep(acquire())
+            self.hedged += 1
+            futures.append(self._pool.submit(attempt))
+        return self._first_valid(model, started, futures)
+
+    def _first_valid(self, model, started, futures):
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    result = self._settle(model, started, future, futures)
+                    for loser in pending:
+                        loser.add_done_callback(lambda loser: self._charge_loser(model, loser, result[0]))
+                    return result
+                error = future.exception()
+        raise error
+
+    async def call_async(self, request, attempt, acquire):
+        # attempt is a coroutine function; the copy that loses is cancelled
+        model = request["model"]
+        self.calls += 1
+        delay = self.delay(model)
+        if delay is None:
+            started = time.perf_counter()
+            result = await attempt()
+            self.observe(model, time.perf_counter() - started)
+            return result
+        started = time.perf_counter()
+        futures = [asyncio.ensure_future(attempt())]
+        done, _ = await asyncio.wait(futures, timeout=delay)
+        if not done:
+            await asyncio.sleep(acquire())
+            self.hedged += 1
+            futures.append(asyncio.ensure_future(attempt()))
+
+        pending = set(futures)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        result = self._settle(model, started, future, futures)
+                        for loser in pending:
+                            loser.cancel()
+                            loser.add_done_callback(lambda loser: self._charge_loser(model, loser, result[0]))
+                        pending = set()
+                        return result
+                    error = future.exception()
+            raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def finish(self):
+        # Waits for losing copies still running in the background (serial mode), so the tokens
+        # they used are in stats()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_rate": self.hedged / self.calls if self.calls else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "extra_prompt_tokens": self.extra_prompt_tokens,
+            "extra_completion_tokens": self.extra_completion_tokens,
+            "extra_cost_usd": self.extra_cost,
+        }
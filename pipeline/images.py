@@ -0,0 +1,328 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+
+import numpy as np
+from PIL import Image
+
+# Image geometry used by the vision models: "low" detail sees a single 512px image; "high"
+# (and "auto") detail fits the image in 2048x2048, then scales the shortest side to 768px
+# before cutting it into 512px tiles. Anything sent above that is downscaled by the provider
+# anyway, so resizing locally saves upload bytes without changing what the model sees.
+LOW_DETAIL_SIZE = 512
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+# Bumped whenever encoding changes what an image looks like, so cached and published encodings
+# made the old way are not reused (2: high bit-depth images are rescaled instead of clipped)
+ENCODING_VERSION = 2
+
+
+def target_size(width, height, detail):
+    if detail == "low":
+        scale = min(1.0, LOW_DETAIL_SIZE / max(width, height))
+    else:
+        scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height), HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def image_content(image_list, prepared=None, detail=None):
+    # Chat-completions content parts for a case's images, using the prepared data URI or handle
+    # of each image when one is available. An image listed twice in a case is sent once. Without
+    # a detail level the parts carry only the URL and the API uses its default ("auto").
+    prepared = prepared or {}
+    urls = dict.fromkeys(prepared.get(img["url"], img["url"]) for img in image_list)
+    options = {} if detail is None else {"detail": detail}
+    return [{"type": "image_url", "image_url": {"url": url, **options}} for url in urls]
+
+
+def is_high_bit_depth(image):
+    return image.mode in ("I", "F") or image.mode.startswith("I;16")
+
+
+def to_8bit(image):
+    # High bit-depth grayscale (16-bit, 32-bit integer or float radiographs) rescaled from its own
+    # min-max range to 8 bits; converting such images directly clips everything above 255
+    pixels = np.asarray(image, dtype=np.float64)
+    low, high = float(pixels.min()), float(pixels.max())
+    scaled = (pixels - low) * (255.0 / (high - low)) if high > low else np.zeros_like(pixels)
+    return Image.fromarray(np.round(scaled).astype(np.uint8), "L")
+
+
+def perceptual_hash(raw, size=8):
+    # 64-bit difference hash: bit i is set when a pixel of the (size + 1) x size grayscale
+    # thumbnail is brighter than its right neighbour. Re-encoded or resized copies of an image
+    # keep (nearly) the same hash.
+    image = Image.open(io.BytesIO(raw))
+    if is_high_bit_depth(image):
+        image = to_8bit(image)
+    image = image.convert("L").resize((size + 1, size), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, :-1] > pixels[:, 1:]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+class ImagePreprocessor:
+    # Loads every unique image once (from image_dir when the file exists there, otherwise
+    # from its URL), downscales it to the model's tile geometry for the configured detail
+    # level, re-encodes it as JPEG and keeps the base64 data URI in cache_dir, keyed by the
+    # SHA-256 of the original bytes.
+    # image_dir is either a mirror laid out by host and path (https://host/a/b/1.jpg is
+    # <image_dir>/host/a/b/1.jpg, as wget --force-directories saves it) or a dict mapping URLs
+    # to local files.
+
+    def __init__(self, cache_dir, image_dir=None, detail="high", jpeg_quality=85, max_workers=8):
+        self.cache_dir = cache_dir
+        self.image_dir = image_dir
+        self.detail = detail
+        self.jpeg_quality = jpeg_quality
+        self.max_workers = max_workers
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cache_hits = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def local_path(self, url):
+        # The local copy of url (None without image_dir), whether or not the file exists
+        if not self.image_dir:
+            return None
+        if isinstance(self.image_dir, dict):
+            return self.image_dir.get(url)
+        parsed = urlparse(url)
+        parts = [parsed.netloc] + [unquote(part) for part in parsed.path.split("/") if part]
+        if any(part in ("", ".", "..") for part in parts):
+            raise ValueError(f"Cannot map {url} into image_dir")
+        return os.path.join(self.image_dir, *parts)
+
+    def check_mirror(self, urls):
+        # Links that differ only in what the mirror layout drops (e.g. the query string) would be
+        # served the same file; they need an explicit URL -> file mapping
+        if not self.image_dir or isinstance(self.image_dir, dict):
+            return
+        seen = {}
+        for url in urls:
+            local_path = self.local_path(url)
+            if seen.setdefault(local_path, url) != url:
+                raise ValueError(f"{seen[local_path]} and {url} both map to {local_path}; "
+                                 f"give image_dir as a dict of URL -> file")
+
+    def _load(self, url):
+        local_path = self.local_path(url)
+        if local_path is not None and os.path.exists(local_path):
+            with open(local_path, "rb") as f:
+                return f.read()
+        with urllib.request.urlopen(url, timeout=60) as response:
+            return response.read()
+
+    def _encode(self, raw):
+        image = Image.open(io.BytesIO(raw))
+        # Radiographs are usually single-channel; keep them that way, it is far smaller
+        if is_high_bit_depth(image):
+            image = to_8bit(image)
+        image = image.convert("L" if image.mode == "L" else "RGB")
+        size = target_size(image.width, image.height, self.detail)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=self.jpeg_quality, optimize=True)
+        return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    def _prepare_one(self, url):
+        raw = self._load(url)
+        return self.encoded(raw, hashlib.sha256(raw).hexdigest())
+
+    def encoding_name(self, digest):
+        return f"{digest}_{self.detail}_q{self.jpeg_quality}_v{ENCODING_VERSION}"
+
+    def encoded(self, raw, digest):
+        # The data URI of an image, from cache_dir when it was encoded before
+        cache_path = os.path.join(self.cache_dir, f"{self.encoding_name(digest)}.txt")
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="ascii") as f:
+                data_uri = f.read()
+            self.cache_hits += 1
+        else:
+            data_uri = self._encode(raw)
+            # Written under a per-process name first, as several shard workers may encode the same image
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="ascii") as f:
+                f.write(data_uri)
+            os.replace(tmp_path, cache_path)
+        self.bytes_in += len(raw)
+        self.bytes_out += len(data_uri)
+        return data_uri
+
+    def prepare(self, image_lists):
+        # Returns {original url: data URI} for every image in image_lists (one image list per case)
+        urls = sorted({img["url"] for image_list in image_lists for img in image_list})
+        self.check_mirror(urls)
+        prepared = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for url, data_uri in zip(urls, pool.map(self._safe_prepare, urls)):
+                if data_uri is not None:
+                    prepared[url] = data_uri
+        print(f"🖼️ Preprocessed {len(prepared)}/{len(urls)} images ({self.cache_hits} from cache), "
+              f"{self.bytes_in / 1e6:.1f} MB in -> {self.bytes_out / 1e6:.1f} MB of data URIs")
+        return prepared
+
+    def _safe_prepare(self, url):
+        try:
+            return self._prepare_one(url)
+        except Exception as e:
+            # The request falls back to the original URL for this image
+            print(f"Error preprocessing image {url}: {str(e)}")
+            return None
+
+
+class InlineUploader:
+    # Local stand-in for an upload endpoint: the handle is the data URI itself, so requests carry
+    # the image inline as before, but each distinct image is encoded once
+
+    def upload(self, name, data_uri):
+        # Returns (handle, bytes uploaded)
+        return data_uri, 0
+
+
+class DirectoryUploader:
+    # Publishes each image once as <directory>/<name>.jpg, a folder served at base_url (a static
+    # file server or a synced bucket), and hands out its URL, so requests carry only the URL and
+    # the provider fetches the image itself
+
+    def __init__(self, directory, base_url):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(directory, exist_ok=True)
+
+    def upload(self, name, data_uri):
+        # An image published by an earlier run (or shard) is not written again
+        path = os.path.join(self.directory, f"{name}.jpg")
+        uploaded = 0
+        if not os.path.exists(path):
+            data = base64.b64decode(data_uri.split(",", 1)[1])
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            uploaded = len(data)
+        return f"{self.base_url}/{name}.jpg", uploaded
+
+
+def _hamming(hash_value, hashes):
+    xor = np.bitwise_xor(np.uint64(hash_value), hashes)
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class ImageRegistry:
+    # One entry per distinct image across all cases and repetitions. Every link is loaded once and
+    # hashed: the SHA-256 of its bytes and, when it decodes, a perceptual hash. Links with the same
+    # bytes share an entry, as do look-alike copies (perceptual hashes within
+    # perceptual_distance bits) when perceptual_distance is set. Each entry is encoded by the
+    # preprocessor once and handed to the uploader once; every request references the resulting
+    # handle.
+
+    def __init__(self, preprocessor, uploader=None, perceptual_distance=None):
+        self.preprocessor = preprocessor
+        self.uploader = uploader or InlineUploader()
+        self.perceptual_distance = perceptual_distance
+        self._lock = threading.Lock()
+        self._encoded = {}
+        self.entries = {}
+        self.handles = {}
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+
+    def _register(self, url):
+        # (url, sha256, perceptual hash or None), encoding the image if its bytes are new
+        raw = self.preprocessor._load(url)
+        digest = hashlib.sha256(raw).hexdigest()
+        try:
+            phash = perceptual_hash(raw)
+        except Exception:
+            phash = None
+        with self._lock:
+            claimed = digest in self._encoded
+            self._encoded.setdefault(digest, None)
+        if not claimed:
+            self._encoded[digest] = self.preprocessor.encoded(raw, digest)
+        return url, digest, phash
+
+    def _safe_register(self, url):
+        try:
+            return self._register(url)
+        except Exception as e:
+            # The request falls back to the original URL for this image
+            print(f"Error preprocessing image {url}: {str(e)}")
+            return None
+
+    def _canonical(self, registered):
+        # Maps every digest to the digest whose handle it uses
+        canonical = {}
+        phashes = {}
+        for _, digest, phash in registered:
+            if digest in canonical:
+                continue
+            canonical[digest] = digest
+            if phash is not None:
+                phashes.setdefault(digest, phash)
+        self.look_alikes = 0
+        kept, kept_hashes = [], np.zeros(0, dtype=np.uint64)
+        for digest, phash in phashes.items():
+            distances = _hamming(phash, kept_hashes)
+            if len(distances) and distances.min() <= (self.perceptual_distance or 0):
+                self.look_alikes += 1
+                if self.perceptual_distance is not None:
+                    canonical[digest] = kept[int(distances.argmin())]
+                    continue
+            kept.append(digest)
+            kept_hashes = np.append(kept_hashes, np.uint64(phash))
+        return canonical
+
+    def prepare(self, image_lists):
+        # Returns {original url: handle} for every image in image_lists (one image list per case)
+        urls = sorted({img["url"] for image_list in image_lists for img in image_list})
+        self.preprocessor.check_mirror(urls)
+        with ThreadPoolExecutor(max_workers=self.preprocessor.max_workers) as pool:
+            registered = [entry for entry in pool.map(self._safe_register, urls) if entry is not None]
+        canonical = self._canonical(registered)
+
+        preprocessor = self.preprocessor
+        for digest in dict.fromkeys(canonical.values()):
+            data_uri = self._encoded[digest]
+            self.entries[digest] = len(data_uri)
+            name = preprocessor.encoding_name(digest)
+            self.handles[digest], uploaded_bytes = self.uploader.upload(name, data_uri)
+            self.uploaded += uploaded_bytes > 0
+            self.uploaded_bytes += uploaded_bytes
+
+        self._urls = {url: canonical[digest] for url, digest, _ in registered}
+        print(f"🖼️ Registered {len(self._urls)}/{len(urls)} image links as {len(self.handles)} distinct images "
+              f"({preprocessor.cache_hits} encodings from cache, {self.look_alikes} perceptual look-alikes "
+              f"{'merged' if self.perceptual_distance is not None else 'kept apart'}), "
+              f"{self.uploaded} uploaded ({self.uploaded_bytes / 1e6:.1f} MB)")
+        return {url: self.handles[digest] for url, digest in self._urls.items()}
+
+    def report(self, image_lists):
+        # Dedup over the image lists the run sends (one per job): references against distinct
+        # images, and request bytes against sending every reference as its own data URI
+        references = [self._urls[img["url"]] for image_list in image_lists for img in image_list
+                      if img["url"] in self._urls]
+        sent = [digest for image_list in image_lists
+                for digest in dict.fromkeys(self._urls[img["url"]] for img in image_list if img["url"] in self._urls)]
+        if not references:
+            return None
+        baseline = sum(self.entries[digest] for digest in references)
+        payload = sum(len(self.handles[digest]) for digest in sent) + self.uploaded_bytes
+        stats = {
+            "references": len(references),
+            "distinct_images": len(set(references)),
+            "dedup_ratio": len(references) / len(set(references)),
+            "bytes_saved": baseline - payload,
+        }
+        print(f"🖼️ Image dedup: {stats['references']} image references in {len(image_lists)} jobs use "
+              f"{stats['distinct_images']} distinct images ({stats['dedup_ratio']:.1f}x), "
+              f"{stats['bytes_saved'] / 1e6:.1f} MB of request payload saved")
+        return stats
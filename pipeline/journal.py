@@ -0,0 +1,128 @@
+import json
+import os
+
+import pandas as pd
+
+from pipeline.results import ResultCollector
+
+
+class Journal:
+    # Append-only JSONL journal with one line per finished (condition, case, repetition) job, per
+    # model when the run fans out to several.
+    # Every line is flushed and fsynced as soon as the job completes, so a crash loses at most
+    # the job in flight. When a job is recorded more than once (e.g. an Error row that is retried
+    # on the next run), the latest line wins.
+
+    def __init__(self, path, condition):
+        self.path = path
+        self.condition = condition
+        self._records = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash mid-write
+                    continue
+                if record.get("condition") == self.condition:
+                    self._records[self.record_key(record)] = record
+
+    @staticmethod
+    def _key(job):
+        return str(job.case_no), job.repetition, job.model
+
+    @staticmethod
+    def record_key(record):
+        # Records of single-model runs have no model
+        return record["case_no"], record["repetition"], record.get("model")
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self):
+        # Latest record of every job of this condition
+        return list(self._records.values())
+
+    def is_done(self, job):
+        record = self._records.get(self._key(job))
+        return record is not None and record["success"]
+
+    def record(self, job, success, **tables):
+        # tables maps an output table name to the list of row dicts this job produced
+        case_no, repetition, model = self._key(job)
+        record = {
+            "condition": self.condition,
+            "case_no": case_no,
+            "case_index": job.case_index,
+            "repetition": repetition,
+            "success": success,
+            "tables": tables,
+        }
+        if model is not None:
+            record["model"] = model
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._records[(case_no, repetition, model)] = record
+
+    def extend(self, records):
+        # Appends finished records as they are, e.g. those merged from shard journals; returns
+        # how many were written
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for record in records:
+            self._records[self.record_key(record)] = record
+        return len(records)
+
+    def to_frame(self, table, columns, model=None):
+        # Rebuild an output table of one model in canonical repetition/case order
+        rows = ResultCollector(columns)
+        records = [record for record in self._records.values() if record.get("model") == model]
+        for record in sorted(records, key=lambda rec: (rec["repetition"], rec["case_index"])):
+            rows.extend(record["tables"].get(table, []))
+        return rows.to_frame()
+
+
+def check_existing_outputs(journal, paths):
+    # Output workbooks are rebuilt from the journal, so workbooks written without one (e.g. by an
+    # earlier version of the scripts) would be overwritten by the first export. Exits instead.
+    if len(journal) or os.path.exists(journal.path):
+        return
+    existing = [path for path in paths if os.path.exists(path)]
+    if existing:
+        raise SystemExit(f"⚠️ Not overwriting {', '.join(existing)}: there is no journal ({journal.path}) to "
+                         f"rebuild them from. Move them aside or choose another output path.")
+
+
+def journal_path(output_path):
+    return os.path.splitext(output_path)[0] + "_journal.jsonl"
+
+
+def journal_frame(path, table="output"):
+    # An output table read back from a journal file, with the Repetition of every row's job, for
+    # analysing finished runs. The journal must hold a single condition and model.
+    records = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[(record.get("condition"), record.get("model")) + Journal.record_key(record)] = record
+    runs = sorted({(condition, model or "") for condition, model, *_ in records})
+    if len(runs) > 1:
+        raise ValueError(f"{path} holds several conditions or models {runs}; score their result stores instead")
+    rows = [
+        dict(row, Repetition=record["repetition"])
+        for record in sorted(records.values(), key=lambda rec: (rec["repetition"], rec["case_index"]))
+        for row in record["tables"].get(table, [])
+    ]
+    return pd.DataFrame(rows)
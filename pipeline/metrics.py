@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+
+import pandas as pd
+
+from pipeline.planner import CACHED_INPUT_PRICES, PRICES
+from pipeline.prompts import usage_tokens
+from pipeline.rate_limit import classify_error
+from pipeline.results import ResultCollector
+
+# Per-request instrumentation: one row per API attempt (one per line in batch mode) with its
+# latency, token usage, image count, outcome and estimated cost. run_jobs merges the rows into
+# the metrics workbook next to the output Excel, keeping those of earlier runs, and rebuilds the
+# per-condition summary from all of them. Summarize several runs, e.g. all four
+# conditions, with: python -m pipeline.metrics PI_metrics.xlsx PI+Text_metrics.xlsx ...
+
+METRIC_COLUMNS = [
+    'Condition', 'Case Number', 'Repetition', 'Attempt', 'Choices', 'Images', 'Started', 'Latency (s)',
+    'Prompt Tokens', 'Cached Tokens', 'Completion Tokens', 'Est. Cost (USD)', 'Outcome', 'Error',
+]
+LATENCY_PERCENTILES = [50, 95, 99]
+
+
+def request_images(request):
+    return sum(
+        1
+        for message in request.get("messages", [])
+        if isinstance(message.get("content"), list)
+        for part in message["content"]
+        if part.get("type") == "image_url"
+    )
+
+
+def request_cost(model, prompt_tokens, cached_tokens, completion_tokens):
+    input_price, output_price = PRICES.get(model, PRICES["gpt-4o"])
+    cached_price = CACHED_INPUT_PRICES.get(model, CACHED_INPUT_PRICES["gpt-4o"])
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + completion_tokens * output_price) / 1_000_000
+
+
+def cache_savings(model, cached_tokens):
+    input_price = PRICES.get(model, PRICES["gpt-4o"])[0]
+    cached_price = CACHED_INPUT_PRICES.get(model, CACHED_INPUT_PRICES["gpt-4o"])
+    return cached_tokens * (input_price - cached_price) / 1_000_000
+
+
+class RequestMetrics:
+    def __init__(self, condition):
+        self.condition = condition
+        self.rows = ResultCollector(METRIC_COLUMNS)
+        self.savings = 0.0
+
+    def record(self, job, request, attempt, started, usage=None, error=None, latency=None, outcome=None):
+        # started is a time.time() timestamp (None for batch lines); latency defaults to the time
+        # elapsed since then. outcome defaults to "ok", or the retry category of error.
+        if latency is None and started is not None:
+            latency = time.time() - started
+        prompt, cached, completion = usage_tokens(usage)
+        self.savings += cache_savings(request["model"], cached)
+        self.rows.append({
+            # Each model of a fanned-out run is summarized as a condition of its own
+            'Condition': self.condition if job.model is None else f"{self.condition}@{job.model}",
+            'Case Number': job.case_no,
+            'Repetition': job.repetition,
+            'Attempt': attempt,
+            'Choices': request.get("n", 1),
+            'Images': request_images(request),
+            'Started': started,
+            'Latency (s)': latency,
+            'Prompt Tokens': prompt,
+            'Cached Tokens': cached,
+            'Completion Tokens': completion,
+            'Est. Cost (USD)': request_cost(request["model"], prompt, cached, completion),
+            'Outcome': outcome or ("ok" if error is None else classify_error(error)),
+            'Error': error if error is None or isinstance(error, str) else f"{type(error).__name__}: {error}",
+        })
+
+    def to_frame(self):
+        return self.rows.to_frame()
+
+    def prompt_cache_stats(self):
+        df = self.to_frame()
+        answered = df[df['Prompt Tokens'] > 0]
+        cached = answered['Cached Tokens'] > 0
+        prompt_tokens = int(df['Prompt Tokens'].sum())
+        cached_tokens = int(df['Cached Tokens'].sum())
+        return {
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "cached_rate": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            "cache_savings_usd": self.savings,
+            "mean_latency_cached_s": _mean(answered.loc[cached, 'Latency (s)']),
+            "mean_latency_uncached_s": _mean(answered.loc[~cached, 'Latency (s)']),
+        }
+
+
+def _mean(latencies):
+    latencies = latencies.dropna()
+    return float(latencies.mean()) if len(latencies) else None
+
+
+def summarize(metrics_df):
+    rows = []
+    for condition, df in metrics_df.groupby('Condition', sort=False):
+        latency = df['Latency (s)'].dropna().astype(float)
+        # Throughput over the span from the first attempt's start to the last attempt's end
+        started = df['Started'].dropna().astype(float)
+        finished = started + df.loc[started.index, 'Latency (s)'].fillna(0).astype(float)
+        span = finished.max() - started.min() if len(started) else 0
+        row = {
+            'Condition': condition,
+            'Attempts': len(df),
+            'Retried Attempts': int((df['Attempt'] > 1).sum()),
+            'Failed Attempts': int((df['Outcome'] != "ok").sum()),
+        }
+        for p in LATENCY_PERCENTILES:
+            row[f'Latency p{p} (s)'] = float(latency.quantile(p / 100)) if len(latency) else None
+        row.update({
+            'Throughput (req/s)': len(df) / span if span else None,
+            'Images': int(df['Images'].sum()),
+            'Prompt Tokens': int(df['Prompt Tokens'].sum()),
+            'Cached Tokens': int(df['Cached Tokens'].sum()),
+            'Completion Tokens': int(df['Completion Tokens'].sum()),
+            'Est. Cost (USD)': float(df['Est. Cost (USD)'].sum()),
+        })
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def failure_reasons(metrics_df):
+    failed = metrics_df[metrics_df['Outcome'] != "ok"]
+    return failed.groupby(['Condition', 'Outcome']).size().rename('Attempts').reset_index()
+
+
+def merge_metrics(earlier_df, metrics_df):
+    # Rows of both, an attempt (job and attempt number) recorded in both keeping its latest row
+    frames = [df for df in (earlier_df, metrics_df) if len(df)]
+    if not frames:
+        return metrics_df
+    combined = pd.concat(frames, ignore_index=True)
+    key = combined[['Condition', 'Case Number', 'Repetition', 'Attempt']].astype(str)
+    return combined[~key.duplicated(keep="last")].reset_index(drop=True)
+
+
+def write_metrics(path, metrics_df):
+    # Adds the rows to those already in the workbook at path; returns all rows
+    if os.path.exists(path):
+        metrics_df = merge_metrics(pd.read_excel(path, sheet_name="requests"), metrics_df)
+    with pd.ExcelWriter(path) as writer:
+        metrics_df.to_excel(writer, sheet_name="requests", index=False)
+        summarize(metrics_df).to_excel(writer, sheet_name="summary", index=False)
+        failure_reasons(metrics_df).to_excel(writer, sheet_name="failures", index=False)
+    return metrics_df
+
+
+def print_summary(summary_df):
+    for row in summary_df.to_dict("records"):
+        latency = ", ".join(
+            f"p{p} {row[f'Latency p{p} (s)']:.2f}s" for p in LATENCY_PERCENTILES
+            if row[f'Latency p{p} (s)'] is not None and not pd.isna(row[f'Latency p{p} (s)'])
+        )
+        throughput = row['Throughput (req/s)']
+        print(f"📈 {row['Condition']}: {row['Attempts']} attempts ({row['Retried Attempts']} retries, "
+              f"{row['Failed Attempts']} failed), latency {latency or 'n/a'}, "
+              f"{f'{throughput:.2f} req/s' if throughput and not pd.isna(throughput) else 'n/a'}, "
+              f"{row['Prompt Tokens']:,} prompt / {row['Cached Tokens']:,} cached / "
+              f"{row['Completion Tokens']:,} completion tokens for {row['Images']} images, "
+              f"est. ${row['Est. Cost (USD)']:.2f}")
+
+
+if __name__ == "__main__":
+    metrics_df = pd.concat(
+        [pd.read_excel(path, sheet_name="requests") for path in sys.argv[1:]], ignore_index=True
+    )
+    print_summary(summarize(metrics_df))
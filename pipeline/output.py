@@ -0,0 +1,157 @@
+import glob
+import json
+import math
+import os
+
+import pandas as pd
+from openpyxl import Workbook
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Incremental output. Instead of rewriting the whole Excel workbook at every checkpoint, flush()
+# appends the journal lines written since the previous flush to a Parquet part per output table,
+# named by the journal byte range it covers, so nothing already written is touched again.
+# export() writes each workbook once, at the end, streaming the rows in canonical
+# repetition/case order through a write-only openpyxl workbook. As in the journal, a job recorded
+# again later (e.g. a retried Error row) replaces its earlier rows. The Excel files hold the same
+# cells as DataFrame.to_excel would write.
+
+_JOB_COLUMNS = ["_case_no", "_repetition", "_model", "_case_index", "_offset"]
+# Part of every flush listing the records it covers, including jobs that produced no rows
+_JOBS_TABLE = "_jobs"
+_JSON_COLUMNS_KEY = b"json_columns"
+
+
+def _cell_value(value):
+    # Empty cells for missing values, text for anything Excel cannot hold, as to_excel does
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def write_excel(path, df, columns):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet1")
+    sheet.append(list(columns))
+    for row in zip(*(df[column].tolist() for column in columns)):
+        sheet.append([_cell_value(value) for value in row])
+    tmp_path = f"{os.path.splitext(path)[0]}.{os.getpid()}.tmp.xlsx"
+    workbook.save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _to_table(df):
+    # Columns mixing value types (e.g. numeric and text ranks) are stored as JSON text, so the
+    # export gets back the values the model returned
+    json_columns = []
+    for column in df.columns[df.dtypes == object]:
+        types = df[column].dropna().map(type)
+        if types.nunique() > 1 or not types.isin([str, int, float, bool]).all():
+            df[column] = df[column].map(lambda value: None if value is None else json.dumps(value, default=str))
+            json_columns.append(column)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = {**(table.schema.metadata or {}), _JSON_COLUMNS_KEY: json.dumps(json_columns).encode()}
+    return table.replace_schema_metadata(metadata)
+
+
+def _from_table(table):
+    df = table.to_pandas(integer_object_nulls=True)
+    for column in json.loads((table.schema.metadata or {}).get(_JSON_COLUMNS_KEY, b"[]")):
+        values = table.column(column).to_pylist()
+        df[column] = pd.Series([None if value is None else json.loads(value) for value in values], dtype=object)
+    return df
+
+
+class PartitionedOutput:
+    # tables maps each output table name to its columns; the parts live in directory
+
+    def __init__(self, journal, tables, directory):
+        self.journal = journal
+        self.tables = tables
+        self.directory = directory
+        self._covered = 0
+        if pq is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._covered = max((self._part_range(path)[1] for path in self._parts()), default=0)
+            size = os.path.getsize(journal.path) if os.path.exists(journal.path) else 0
+            if self._covered > size:
+                # The journal was replaced or truncated; its parts no longer describe it
+                for path in self._parts():
+                    os.remove(path)
+                self._covered = 0
+
+    def _parts(self, table="*"):
+        return sorted(glob.glob(os.path.join(glob.escape(self.directory), f"part-*-*-{table}.parquet")))
+
+    @staticmethod
+    def _part_range(path):
+        _, start, end, _ = os.path.basename(path).split("-", 3)
+        return int(start), int(end)
+
+    def flush(self):
+        # Writes the complete journal lines past the last part; returns the number of jobs flushed
+        if pq is None or not os.path.exists(self.journal.path):
+            return 0
+        with open(self.journal.path, "rb") as f:
+            f.seek(self._covered)
+            data = f.read()
+        end = self._covered + data.rfind(b"\n") + 1
+        if end <= self._covered:
+            return 0
+
+        rows = {table: [] for table in self.tables}
+        jobs = []
+        offset = self._covered
+        for line in data[:end - self._covered].splitlines(keepends=True):
+            # The journal offset of a record orders the records of a job, newest last
+            line_offset, offset = offset, offset + len(line)
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("condition") != self.journal.condition:
+                continue
+            job_fields = {"_case_no": record["case_no"], "_repetition": record["repetition"],
+                          "_model": record.get("model") or "", "_case_index": record["case_index"],
+                          "_offset": line_offset}
+            jobs.append(job_fields)
+            for table in self.tables:
+                rows[table].extend(dict(row, **job_fields) for row in record["tables"].get(table, []))
+
+        rows[_JOBS_TABLE] = jobs
+        for table, columns in dict(self.tables, **{_JOBS_TABLE: []}).items():
+            df = pd.DataFrame(rows[table], columns=list(columns) + _JOB_COLUMNS)
+            path = os.path.join(self.directory, f"part-{self._covered:012d}-{end:012d}-{table}.parquet")
+            pq.write_table(_to_table(df), path + ".tmp")
+            os.replace(path + ".tmp", path)
+        self._covered = end
+        return len(jobs)
+
+    def frame(self, table, model=None, repetition=False):
+        # The table of one model in canonical order, with only the latest rows of every job;
+        # repetition adds the job's repetition as a Repetition column (with pyarrow)
+        if pq is None:
+            return self.journal.to_frame(table, self.tables[table], model)
+        self.flush()
+        columns = list(self.tables[table])
+        parts = [_from_table(pq.read_table(path)) for path in self._parts(table)]
+        if not parts:
+            return pd.DataFrame(columns=columns + ["Repetition"] * repetition)
+        df = pd.concat(parts, ignore_index=True)
+        jobs = pd.concat([pq.read_table(path).to_pandas() for path in self._parts(_JOBS_TABLE)], ignore_index=True)
+        latest = jobs.groupby(["_case_no", "_repetition", "_model"])["_offset"].max()
+        df = df[df["_offset"].isin(latest) & (df["_model"] == (model or ""))]
+        df = df.sort_values(["_repetition", "_case_index"], kind="stable")
+        if repetition:
+            df = df.rename(columns={"_repetition": "Repetition"})
+            columns.append("Repetition")
+        return df[columns].reset_index(drop=True)
+
+    def export(self, table, path, model=None):
+        write_excel(path, self.frame(table, model), self.tables[table])
@@ -0,0 +1,29 @@
+import json
+import re
+
+from pipeline.schemas import validate
+
+
+def response_text(response):
+    # Validate if the response is empty
+    if not response.choices or not (response.choices[0].message.content or "").strip():
+        raise ValueError("Received an empty response from the API.")
+    return response.choices[0].message.content
+
+
+def extract_response_data(response_json, schema=None):
+    # Remove comments or non-JSON parts using regular expressions
+    # This will match and extract the JSON part within the response
+    json_match = re.search(r"\{.*\}", response_json, re.DOTALL)
+    if not json_match:
+        raise ValueError("No valid JSON object found in the response.")
+    response_data = json.loads(json_match.group(0))  # Parsing the string as JSON
+
+    # Must contain the expected list
+    if "differential_diagnoses" not in response_data:
+        raise ValueError("Invalid JSON structure: 'differential_diagnoses' not found.")
+
+    # With structured outputs the whole object must match the requested schema
+    if schema is not None:
+        validate(response_data, schema)
+    return response_data
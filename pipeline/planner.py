@@ -0,0 +1,191 @@
+import base64
+import io
+import math
+import os
+import urllib.request
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from pipeline.images import target_size
+from pipeline.rate_limit import CHARS_PER_TOKEN, HIGH_DETAIL_IMAGE_TOKENS, LOW_DETAIL_IMAGE_TOKENS
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# USD per 1M tokens (input, output)
+PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+# USD per 1M prompt tokens served from the provider's prompt cache
+CACHED_INPUT_PRICES = {
+    "gpt-4o": 1.25,
+    "gpt-4o-mini": 0.075,
+}
+# Per-message overhead of the chat format
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+# Output size assumed when there is no history to learn from
+DEFAULT_OUTPUT_TOKENS = 1500
+
+
+def _encoding(model):
+    # None (character-count estimate) when tiktoken or its encoding file is unavailable
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"Error loading the tokenizer for {model}: {str(e)}")
+        return None
+
+
+def count_text_tokens(text, encoding):
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN
+    return len(encoding.encode(text))
+
+
+def image_dimensions(url):
+    # Reads just enough of the image to get its size; None when it cannot be read
+    try:
+        if url.startswith("data:"):
+            raw = base64.b64decode(url.split(",", 1)[1])
+        else:
+            request = urllib.request.Request(url, headers={"Range": "bytes=0-65535"})
+            with urllib.request.urlopen(request, timeout=30) as response:
+                raw = response.read(65536)
+        return Image.open(io.BytesIO(raw)).size
+    except Exception:
+        return None
+
+
+def image_tokens(width, height, detail):
+    # 85 base tokens plus 170 per 512px tile of the image as the model sees it
+    if detail == "low":
+        return LOW_DETAIL_IMAGE_TOKENS
+    width, height = target_size(width, height, "high")
+    return LOW_DETAIL_IMAGE_TOKENS + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+class TokenPlanner:
+    # Dry run: builds every request without sending it and estimates its size and cost
+
+    def __init__(self, model="gpt-4o", output_token_history=None):
+        self.model = model
+        self.encoding = _encoding(model)
+        self.output_token_history = list(output_token_history or [])
+        self._dimensions = {}
+        if self.encoding is None:
+            print("⚠️ No local tokenizer available, estimating text tokens from character counts")
+
+    def prompt_tokens(self, request):
+        text_tokens, image_count, image_total = TOKENS_PER_REPLY, 0, 0
+        for message in request["messages"]:
+            text_tokens += TOKENS_PER_MESSAGE
+            content = message["content"]
+            if isinstance(content, str):
+                text_tokens += count_text_tokens(content, self.encoding)
+                continue
+            for part in content:
+                if part["type"] == "text":
+                    text_tokens += count_text_tokens(part["text"], self.encoding)
+                elif part["type"] == "image_url":
+                    url = part["image_url"]["url"]
+                    if url not in self._dimensions:
+                        self._dimensions[url] = image_dimensions(url)
+                    size = self._dimensions[url]
+                    detail = part["image_url"].get("detail", "auto")
+                    image_count += 1
+                    if size is None:
+                        image_total += LOW_DETAIL_IMAGE_TOKENS if detail == "low" else HIGH_DETAIL_IMAGE_TOKENS
+                    else:
+                        image_total += image_tokens(size[0], size[1], detail)
+        return text_tokens, image_count, image_total
+
+    def output_tokens(self):
+        if not self.output_token_history:
+            return DEFAULT_OUTPUT_TOKENS
+        return float(np.mean(self.output_token_history))
+
+    def suggested_max_tokens(self, min_samples=20, headroom=1.2):
+        # p99 of the observed output sizes plus headroom, rounded up to a multiple of 256
+        if len(self.output_token_history) < min_samples:
+            return None
+        p99 = np.percentile(self.output_token_history, 99)
+        return int(math.ceil(p99 * headroom / 256) * 256)
+
+    def plan(self, jobs, build_request, sample_with_n=False):
+        # Jobs fanned out to several models are priced at their own model's rates
+        expected_output = self.output_tokens()
+        rows = []
+        by_case = {}
+        for job in jobs:
+            by_case.setdefault((job.model, job.case_index), []).append(job)
+        for (model, _), case_jobs in by_case.items():
+            input_price, output_price = PRICES.get(model or self.model, PRICES["gpt-4o"])
+            request = build_request(case_jobs[0])
+            text_tokens, image_count, image_total = self.prompt_tokens(request)
+            repetitions = len(case_jobs)
+            # With n-sampling the prompt is sent once for all repetitions of a case
+            prompt_sends = 1 if sample_with_n else repetitions
+            prompt_tokens = (text_tokens + image_total) * prompt_sends
+            output_tokens = expected_output * repetitions
+            rows.append({
+                'Model': model or self.model,
+                'Case Number': case_jobs[0].case_no,
+                'Repetitions': repetitions,
+                'Requests': prompt_sends,
+                'Text Tokens': text_tokens,
+                'Images': image_count,
+                'Image Tokens': image_total,
+                'Prompt Tokens': prompt_tokens,
+                'Est. Output Tokens': round(output_tokens),
+                'Est. Cost (USD)': (prompt_tokens * input_price + output_tokens * output_price) / 1e6,
+            })
+        return pd.DataFrame(rows, columns=['Model', 'Case Number', 'Repetitions', 'Requests', 'Text Tokens', 'Images',
+                                           'Image Tokens', 'Prompt Tokens', 'Est. Output Tokens', 'Est. Cost (USD)'])
+
+    def report(self, plan_df, max_tokens):
+        image_tokens_total = int((plan_df['Image Tokens'] * plan_df['Requests']).sum())
+        if self.output_token_history:
+            output_basis = f"mean of {len(self.output_token_history)} past responses"
+        else:
+            output_basis = f"no history, assuming {DEFAULT_OUTPUT_TOKENS} per response"
+        models = ", ".join(plan_df['Model'].unique()) or self.model
+        print(f"\n📋 Plan for {models}: {len(plan_df)} pending cases, {int(plan_df['Repetitions'].sum())} jobs, "
+              f"{int(plan_df['Requests'].sum())} requests")
+        print(f"   Prompt tokens: {int(plan_df['Prompt Tokens'].sum()):,} ({image_tokens_total:,} for images)")
+        print(f"   Est. output tokens: {int(plan_df['Est. Output Tokens'].sum()):,} ({output_basis})")
+        print(f"   Est. cost: ${plan_df['Est. Cost (USD)'].sum():.2f}")
+        suggested = self.suggested_max_tokens()
+        if suggested is None:
+            print(f"   max_tokens: {max_tokens} (not enough history to suggest a tighter value)")
+        else:
+            print(f"   max_tokens: {max_tokens}, suggested {suggested} (p99 of past outputs + 20%)")
+        return suggested
+
+
+def output_token_history(metrics_paths):
+    # Completion tokens of past successful responses, as the API reported them in the per-request
+    # metrics (see pipeline.metrics) of earlier runs; an n-choice request counts as n responses of
+    # its mean size. Missing files are skipped.
+    if isinstance(metrics_paths, str):
+        metrics_paths = [metrics_paths]
+    history = []
+    for path in metrics_paths:
+        if not os.path.exists(path):
+            continue
+        df = pd.read_excel(path, sheet_name="requests")
+        df = df[(df['Outcome'] == "ok") & (df['Completion Tokens'] > 0)]
+        choices = df['Choices'].fillna(1).clip(lower=1).astype(int)
+        per_choice = (df['Completion Tokens'] / choices).round().astype(int)
+        history.extend(np.repeat(per_choice.to_numpy(), choices.to_numpy()).tolist())
+    return history
@@ -0,0 +1,54 @@
+import textwrap
+
+# Prompt templates shared by the four conditions. A template is the condition's prompt text with
+# str.format fields; the per-case section runs from the line holding case_start up to the line
+# holding case_end. "original" renders the text exactly as the scripts used to build it.
+# "compact" strips the indentation and blank-line padding and moves every static line
+# (instructions and the JSON example) ahead of the case section. Every request of a condition
+# then starts with the same token prefix, which the provider can serve from its prompt cache.
+
+LAYOUTS = ("original", "compact")
+
+
+def compact(text):
+    lines = [line.rstrip() for line in textwrap.dedent(text).splitlines()]
+    kept = []
+    for line in lines:
+        # Runs of blank lines collapse into one
+        if line or (kept and kept[-1]):
+            kept.append(line)
+    return "\n".join(kept).strip()
+
+
+def _line_start(text, marker):
+    return text.rindex("\n", 0, text.index(marker)) + 1
+
+
+class PromptTemplate:
+    def __init__(self, text, case_start="### Patient Information", case_end="Provide the result"):
+        start = _line_start(text, case_start)
+        end = _line_start(text, case_end)
+        self.text = text
+        # format() with no fields only unescapes the {{ }} of the JSON example
+        self.prefix = compact(text[:start] + "\n" + text[end:]).format()
+        self.case = compact(text[start:end])
+
+    def render(self, layout="original", **fields):
+        if layout == "original":
+            return self.text.format(**fields)
+        if layout == "compact":
+            return self.prefix + "\n\n" + self.case.format(**fields)
+        raise ValueError(f"Unknown prompt layout: {layout}")
+
+
+def usage_tokens(usage):
+    # (prompt, cached prompt, completion) tokens of a response's usage field, or of the usage
+    # dict of a batch output line
+    if usage is None:
+        return 0, 0, 0
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details") or {}
+        return usage.get("prompt_tokens") or 0, details.get("cached_tokens") or 0, usage.get("completion_tokens") or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    return usage.prompt_tokens or 0, cached, usage.completion_tokens or 0
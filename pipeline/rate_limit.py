@@ -0,0 +1,143 @@
+import json
+import random
+import threading
+import time
+
+import openai
+
+# Token estimate for a high-detail image scaled to 1024x1024 (4 tiles x 170 + 85 base)
+# and for a low-detail image
+HIGH_DETAIL_IMAGE_TOKENS = 765
+LOW_DETAIL_IMAGE_TOKENS = 85
+CHARS_PER_TOKEN = 4
+
+# What to do after a failed attempt
+BACKOFF = "backoff"    # transient server-side problem: wait with exponential backoff, then retry
+RESAMPLE = "resample"  # the model answered but the output was unusable: retry at once, no backoff
+FAIL = "fail"          # the request itself is wrong (auth, invalid request): retrying cannot help
+
+
+def estimate_request_tokens(request):
+    # Rough token reservation for a chat-completions request: prompt text, images and the
+    # completion budget (the provider reserves max_tokens against the token-per-minute limit)
+    tokens = 0
+    for message in request.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part["text"]) // CHARS_PER_TOKEN
+            elif part.get("type") == "image_url":
+                detail = part["image_url"].get("detail", "auto")
+                tokens += LOW_DETAIL_IMAGE_TOKENS if detail == "low" else HIGH_DETAIL_IMAGE_TOKENS
+    return tokens + request.get("max_tokens", 0) * request.get("n", 1)
+
+
+def classify_error(error):
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                          openai.InternalServerError)):
+        return BACKOFF
+    if isinstance(error, openai.APIStatusError):
+        return BACKOFF if error.status_code in (408, 409) or error.status_code >= 500 else FAIL
+    if isinstance(error, (ValueError, json.JSONDecodeError)):
+        return RESAMPLE
+    return BACKOFF
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+class TokenBucket:
+    # Continuously refilling bucket; reserve() may take the balance negative and returns how
+    # long the caller has to wait until its reservation is covered
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    # Shared request-per-minute and token-per-minute limiter with exponential backoff and jitter.
+    # acquire() and backoff() return the number of seconds to wait, so the same limiter drives
+    # time.sleep in the serial path and asyncio.sleep in the async path.
+
+    def __init__(self, requests_per_minute=5000, tokens_per_minute=800000, base_delay=1.0, max_delay=60.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.throttled_s = 0.0
+        self.backoff_s = 0.0
+        self.throttled_requests = 0
+        self.errors = {BACKOFF: 0, RESAMPLE: 0, FAIL: 0}
+        self.rate_limit_errors = 0
+
+    def acquire(self, request):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(estimate_request_tokens(request), now),
+                self.blocked_until - now,
+            )
+            if delay > 0:
+                self.throttled_s += delay
+                self.throttled_requests += 1
+        return delay
+
+    def backoff(self, error, attempt):
+        # Returns None when the error is not worth retrying
+        disposition = classify_error(error)
+        with self._lock:
+            self.errors[disposition] += 1
+            if disposition == FAIL:
+                return None
+            if disposition == RESAMPLE:
+                return 0.0
+
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            if isinstance(error, openai.RateLimitError):
+                self.rate_limit_errors += 1
+                retry_after = _retry_after(error)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                # Throttling applies to the whole key, so hold back every other request as well
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.backoff_s += delay
+        return delay
+
+    def stats(self):
+        return {
+            "throttled_s": self.throttled_s,
+            "throttled_requests": self.throttled_requests,
+            "backoff_s": self.backoff_s,
+            "rate_limit_errors": self.rate_limit_errors,
+            "transient_errors": self.errors[BACKOFF],
+            "output_errors": self.errors[RESAMPLE],
+            "fatal_errors": self.errors[FAIL],
+        }
@@ -0,0 +1,25 @@
+import pandas as pd
+
+
+class ResultCollector:
+    # Append-only, column-wise row buffer. Appending is O(1); the DataFrame is built
+    # in one go by to_frame() instead of being re-concatenated for every row.
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self._data = {column: [] for column in self.columns}
+
+    def __len__(self):
+        return len(self._data[self.columns[0]])
+
+    def append(self, row):
+        # Columns missing from the row are left empty, as pd.concat would do
+        for column in self.columns:
+            self._data[column].append(row.get(column))
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def to_frame(self):
+        return pd.DataFrame(self._data, columns=self.columns)
@@ -0,0 +1,57 @@
+# JSON schemas for the structured-output response format. They mirror the JSON example in each
+# condition's prompt; only PI+Image asks for image_findings.
+
+DIAGNOSIS_FIELDS = ["rank", "diagnosis", "reason_for_consideration", "distinguishing_features"]
+
+
+def diagnosis_schema(include_image_findings=False):
+    properties = {
+        "differential_diagnoses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {field: {"type": "string"} for field in DIAGNOSIS_FIELDS},
+                "required": list(DIAGNOSIS_FIELDS),
+                "additionalProperties": False,
+            },
+        },
+    }
+    if include_image_findings:
+        properties = {"image_findings": {"type": "string"}, **properties}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def response_format(schema, name="differential_diagnosis"):
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": schema},
+    }
+
+
+_TYPES = {"object": dict, "array": list, "string": str}
+
+
+def validate(value, schema, path="$"):
+    # Checks the subset of JSON Schema used above (type, properties, required, items,
+    # additionalProperties) and raises ValueError naming the first offending path
+    expected = _TYPES[schema["type"]]
+    if not isinstance(value, expected):
+        raise ValueError(f"Schema violation at {path}: expected {schema['type']}, got {type(value).__name__}.")
+    if schema["type"] == "object":
+        for key in schema.get("required", []):
+            if key not in value:
+                raise ValueError(f"Schema violation at {path}: '{key}' not found.")
+        properties = schema.get("properties", {})
+        for key, item in value.items():
+            if key in properties:
+                validate(item, properties[key], f"{path}.{key}")
+            elif schema.get("additionalProperties") is False:
+                raise ValueError(f"Schema violation at {path}: unexpected key '{key}'.")
+    elif schema["type"] == "array":
+        for i, item in enumerate(value):
+            validate(item, schema["items"], f"{path}[{i}]")
@@ -0,0 +1,236 @@
+import argparse
+import difflib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from pipeline.journal import journal_frame, journal_path
+from pipeline.store import ResultStore, is_result_store
+
+try:
+    from rapidfuzz.distance import Indel
+except ImportError:
+    Indel = None
+
+# Top-k diagnostic accuracy. The long-format output of each condition (Case Number, Rank,
+# Diagnosis) is joined with the ground-truth Diagnosis of the dataset. Every predicted
+# diagnosis is matched against the truth, either by normalized string equality or by fuzzy
+# similarity, and each case scores a hit at k when a match has rank <= k. The similarity is
+# computed once per distinct (prediction, truth) pair and broadcast back to the rows, which keeps
+# hundreds of thousands of rows to a few seconds. Confidence intervals come from a bootstrap
+# over cases.
+# Run: python -m pipeline.scoring dataset.xlsx PI=PI_output.xlsx PI+Text=PI+Text_output.xlsx ...
+# (each output workbook needs its <output>_journal.jsonl alongside, or pass a result store)
+
+TOP_K = [1, 3, 5]
+# Similar names of different entities (e.g. adenocarcinoma subtypes) score around 0.8
+FUZZY_THRESHOLD = 0.9
+BOOTSTRAP_SAMPLES = 2000
+CONFIDENCE = 0.95
+
+_ALPHABET = {char: i for i, char in enumerate(" 0123456789abcdefghijklmnopqrstuvwxyz")}
+_PAIR_CHUNK = 100_000
+_PARENTHESES = re.compile(r"\([^)]*\)")
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+_OUTPUT_COLUMNS = ("Case Number", "Rank", "Diagnosis", "Repetition")
+
+
+def normalize(series):
+    # Lower case, parenthesised asides and punctuation removed, whitespace collapsed
+    text = series.fillna("").astype(str).str.lower()
+    text = text.str.replace(_PARENTHESES, " ", regex=True).str.replace(_NON_WORD, " ", regex=True)
+    return text.str.strip()
+
+
+def _normalized_codes(series):
+    # (codes, normalized distinct values): outputs repeat the same few hundred names, so only
+    # the distinct strings go through the regexes
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Already dictionary-encoded (result stores); missing values (code -1) become ""
+        categories = series.cat.categories.astype(str).tolist()
+        codes = series.cat.codes.to_numpy()
+        names = normalize(pd.Series(categories + [""], dtype=object)).to_numpy(dtype=object)
+        return np.where(codes < 0, len(categories), codes), names
+    codes, uniques = pd.factorize(series.fillna("").astype(str))
+    return codes, normalize(pd.Series(uniques)).to_numpy(dtype=object)
+
+
+def _similarity(a, b):
+    if Indel is not None:
+        return Indel.normalized_similarity(a, b)
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def match(predicted, truth, method="exact", threshold=FUZZY_THRESHOLD):
+    # Boolean array, True where the normalized prediction matches the normalized truth
+    predicted_codes, predicted_names = _normalized_codes(predicted)
+    truth_codes, truth_names = _normalized_codes(truth)
+    predicted = predicted_names[predicted_codes]
+    truth = truth_names[truth_codes]
+    exact = (predicted == truth) & (truth != "")
+    if method == "exact":
+        return exact
+    if method != "fuzzy":
+        raise ValueError(f"Unknown match method: {method}")
+
+    # Each distinct (prediction, truth) pair is scored once, on word-sorted names so word order
+    # does not matter. Both similarity measures are at most 2 * (characters in common) /
+    # (total length), computed for all pairs at once from character counts; only the pairs
+    # that bound lets through are scored one by one.
+    predicted_sorted = [" ".join(sorted(name.split())) for name in predicted_names]
+    truth_sorted = [" ".join(sorted(name.split())) for name in truth_names]
+    pair_codes, pairs = pd.factorize(predicted_codes.astype(np.int64) * len(truth_names) + truth_codes)
+    p_index, t_index = np.divmod(pairs, len(truth_names))
+    p_counts, t_counts = _char_counts(predicted_sorted), _char_counts(truth_sorted)
+    scores = np.zeros(len(pairs))
+    for start in range(0, len(pairs), _PAIR_CHUNK):
+        p, t = p_index[start:start + _PAIR_CHUNK], t_index[start:start + _PAIR_CHUNK]
+        common = np.minimum(p_counts[p], t_counts[t]).sum(axis=1)
+        total = p_counts[p].sum(axis=1) + t_counts[t].sum(axis=1)
+        bound = np.where(total > 0, 2 * common / np.maximum(total, 1), 0.0)
+        for i in np.flatnonzero(bound >= threshold):
+            scores[start + i] = _similarity(predicted_sorted[p[i]], truth_sorted[t[i]])
+    return exact | (scores[pair_codes] >= threshold)
+
+
+def _char_counts(names):
+    # (names, alphabet) matrix of character counts; names are already lower-case alphanumerics
+    counts = np.zeros((len(names), len(_ALPHABET)), dtype=np.int32)
+    for row, name in enumerate(names):
+        for char in name:
+            counts[row, _ALPHABET.get(char, 0)] += 1
+    return counts
+
+
+def first_hit_ranks(output_df, truth_df, method="exact", threshold=FUZZY_THRESHOLD):
+    # One row per job that ran (condition, repetition and ground-truth case) with the rank of the
+    # first matching diagnosis (inf when none matches or the job failed). Every job that ran left
+    # rows, an Error row when it failed, so repetitions adaptive sampling skipped for a case are
+    # absent rather than misses. A ground-truth case a condition never ran at all counts as a
+    # miss in each of its repetitions.
+    # Case numbers are compared as text; Excel may have read them as numbers on one side only
+    output_df = output_df.assign(**{"Case Number": output_df["Case Number"].astype(str)})
+    truth_df = truth_df.assign(**{"Case Number": truth_df["Case Number"].astype(str)})
+    df = output_df.merge(truth_df, on="Case Number", how="inner")
+    rank = pd.to_numeric(df["Rank"], errors="coerce")
+    hit_rank = rank.where(match(df["Diagnosis"], df["True Diagnosis"], method, threshold), np.inf)
+    first = (
+        df.assign(**{"First Hit Rank": hit_rank.fillna(np.inf)})
+        .groupby(["Condition", "Repetition", "Case Number"])["First Hit Rank"].min()
+        .reset_index()
+    )
+
+    runs = df[["Condition", "Repetition"]].drop_duplicates()
+    grid = runs.merge(truth_df[["Case Number"]], how="cross")
+    ran = grid.merge(df[["Condition", "Case Number"]].drop_duplicates(), how="left", indicator=True)
+    missing = ran[ran["_merge"] == "left_only"].drop(columns="_merge").assign(**{"First Hit Rank": np.inf})
+    return pd.concat([first, missing], ignore_index=True)
+
+
+def bootstrap_ci(hits, samples=BOOTSTRAP_SAMPLES, confidence=CONFIDENCE, seed=0):
+    # hits is (cases, ) or (cases, repetitions), NaN for repetitions a case did not run; cases are
+    # resampled with all their repetitions, i.e. the per-case hit rates are resampled. The rates
+    # take few distinct values, so a resample is a multinomial draw of how often each is picked.
+    hits = np.asarray(hits, dtype=float)
+    if len(hits) == 0:
+        return np.nan, np.nan
+    values, counts = np.unique(np.nanmean(hits.reshape(len(hits), -1), axis=1), return_counts=True)
+    rng = np.random.default_rng(seed)
+    draws = rng.multinomial(len(hits), counts / len(hits), size=samples)
+    means = draws @ values / len(hits)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+
+def accuracy_table(ranks_df, top_k=TOP_K, samples=BOOTSTRAP_SAMPLES, confidence=CONFIDENCE):
+    # Accuracy per condition and repetition, plus "all" pooling the repetitions of a condition.
+    # Only the repetitions a case ran count as its trials; pooled accuracy is the mean of the
+    # per-case hit rates, so cases sampled more often (adaptive repetitions) do not weigh more.
+    rows = []
+    for condition, condition_df in ranks_df.groupby("Condition", sort=False):
+        wide = condition_df.pivot(index="Case Number", columns="Repetition", values="First Hit Rank")
+        ran = wide.notna().to_numpy()
+        for k in top_k:
+            hits = np.where(ran, wide.to_numpy() <= k, np.nan)
+            columns = [(repetition, hits[ran[:, i]][:, [i]]) for i, repetition in enumerate(wide.columns)]
+            columns.append(("all", hits[ran.any(axis=1)]))
+            for repetition, repetition_hits in columns:
+                low, high = bootstrap_ci(repetition_hits, samples, confidence)
+                trials = int((~np.isnan(repetition_hits)).sum())
+                rows.append({
+                    "Condition": condition,
+                    "Repetition": repetition,
+                    "k": k,
+                    "Cases": len(repetition_hits),
+                    "Trials": trials,
+                    "Correct": int(np.nansum(repetition_hits)),
+                    "Accuracy": float(np.nanmean(np.nanmean(repetition_hits, axis=1))) if trials else np.nan,
+                    "CI Low": low,
+                    "CI High": high,
+                })
+    return pd.DataFrame(rows)
+
+
+def load_truth(dataset_path):
+    dataset = pd.read_excel(dataset_path)
+    return dataset[["Case_No", "Diagnosis"]].rename(columns={"Case_No": "Case Number", "Diagnosis": "True Diagnosis"})
+
+
+def load_outputs(outputs):
+    # outputs maps condition -> output Excel path, journal, result store (see pipeline.store) or
+    # DataFrame. The repetition of every row comes from the store, the journal, or the frame's
+    # Repetition column; an Excel output is read through the journal next to it, as the workbook
+    # does not record repetitions.
+    frames = []
+    for condition, output in outputs.items():
+        if is_result_store(output):
+            # Only the columns scoring needs are mapped; diagnoses stay categorical until normalized
+            store = ResultStore(output)
+            df = store.frame([column for column in _OUTPUT_COLUMNS if column in store.columns])
+        elif isinstance(output, pd.DataFrame):
+            df = output
+        elif output.endswith(".jsonl"):
+            df = journal_frame(output)
+        elif os.path.exists(journal_path(output)):
+            df = journal_frame(journal_path(output))
+        else:
+            raise ValueError(f"{condition}: {output} has no journal ({journal_path(output)}) to take the "
+                             f"repetitions from; pass its journal or result store")
+        if "Repetition" not in df.columns:
+            raise ValueError(f"{condition}: {output if isinstance(output, str) else 'the frame'} has no "
+                             f"Repetition column; pass its journal or a result store written by the script")
+        df = df[[column for column in _OUTPUT_COLUMNS if column in df.columns]]
+        frames.append(df.assign(Condition=condition))
+    return pd.concat(frames, ignore_index=True)
+
+
+def score(outputs, truth_df, method="exact", threshold=FUZZY_THRESHOLD, top_k=TOP_K,
+          samples=BOOTSTRAP_SAMPLES, confidence=CONFIDENCE):
+    ranks_df = first_hit_ranks(load_outputs(outputs), truth_df, method, threshold)
+    return accuracy_table(ranks_df, top_k, samples, confidence)
+
+
+def print_scores(scores_df):
+    pooled = scores_df[scores_df["Repetition"] == "all"]
+    for row in pooled.to_dict("records"):
+        print(f"🎯 {row['Condition']} top-{row['k']}: {row['Accuracy']:.1%} "
+              f"({row['CI Low']:.1%}-{row['CI High']:.1%} CI, {row['Correct']}/{row['Trials']} case-repetitions)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Top-k accuracy of the condition outputs")
+    parser.add_argument("dataset", help="dataset Excel file with Case_No and Diagnosis")
+    parser.add_argument("outputs", nargs="+", help="CONDITION=output.xlsx, its journal or result store")
+    parser.add_argument("--method", choices=["exact", "fuzzy"], default="exact")
+    parser.add_argument("--threshold", type=float, default=FUZZY_THRESHOLD)
+    parser.add_argument("--output", help="Excel file for the accuracy table")
+    args = parser.parse_args()
+
+    outputs = dict(output.split("=", 1) for output in args.outputs)
+    scores_df = score(outputs, load_truth(args.dataset), args.method, args.threshold)
+    print_scores(scores_df)
+    if args.output:
+        scores_df.to_excel(args.output, index=False)
@@ -0,0 +1,145 @@
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+
+from pipeline.journal import Journal
+
+# Sharded execution. The (case, repetition) jobs of a condition are split into num_shards shards
+# by a stable hash, so every process, machine or API key given the same shard count agrees on
+# which jobs it owns without coordinating. Each shard writes its own journal, metrics and output
+# (<output>_shard<i>of<N>), and merging folds the shard journals into the condition's journal,
+# from which the final output is rebuilt in canonical repetition/case order.
+# Run: python -m pipeline.sharding PI+Text.py --shards 4 [--only 0 1] [--no-merge]
+
+# The scripts read NUM_SHARDS, SHARD_INDEX, MERGE_SHARDS and SHARD_API_KEY from the environment;
+# the launcher sets them for each worker and hands out the comma-separated keys in SHARD_API_KEYS
+# round-robin
+
+
+def shard_of(job, num_shards):
+    # Depends only on the case number and repetition, not on the job's position in the run
+    key = f"{job.case_no}\x1f{job.repetition}".encode("utf-8")
+    return int.from_bytes(hashlib.sha256(key).digest()[:8], "big") % num_shards
+
+
+def shard_jobs(jobs, shard_index, num_shards):
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index must be in [0, {num_shards}), got {shard_index}")
+    return [job for job in jobs if shard_of(job, num_shards) == shard_index]
+
+
+def shard_path(path, shard_index, num_shards):
+    base, ext = os.path.splitext(path)
+    return f"{base}_shard{shard_index + 1}of{num_shards}{ext}"
+
+
+def merge_shard_journals(journal, output_file_path, num_shards, jobs, dead_letters=None):
+    # Folds the journals of the shards of output_file_path into journal and reports duplicate,
+    # failed and missing jobs. A job found in several shards (e.g. after changing the shard
+    # count) keeps a successful record, preferring the shard that owns it under num_shards.
+    # dead_letters (a pipeline.dead_letter.DeadLetterStore) receives the shards' dead letters of
+    # the jobs that are still failed after the merge.
+    shard_records = {}
+    duplicates = 0
+    owned = {shard_of(job, num_shards) for job in jobs}
+    for shard_index in range(num_shards):
+        shard_output_path = shard_path(output_file_path, shard_index, num_shards)
+        shard_journal_path = os.path.splitext(shard_output_path)[0] + "_journal.jsonl"
+        if not os.path.exists(shard_journal_path):
+            if shard_index in owned:
+                print(f"⚠️ No journal for shard {shard_index + 1}/{num_shards} ({shard_journal_path})")
+            continue
+        for record in Journal(shard_journal_path, journal.condition).records():
+            key = Journal.record_key(record)
+            if key in shard_records:
+                duplicates += 1
+            shard_records.setdefault(key, []).append((shard_index, record))
+
+    merged = []
+    missing = []
+    failed = []
+    for job in jobs:
+        key = Journal._key(job)
+        candidates = shard_records.get(key)
+        if not candidates:
+            if not journal.is_done(job):
+                missing.append(job)
+            continue
+        owner = shard_of(job, num_shards)
+        _, record = max(candidates, key=lambda candidate: (candidate[1]["success"], candidate[0] == owner))
+        if not record["success"]:
+            if journal.is_done(job):
+                # An earlier merge or run already holds a result for it
+                continue
+            failed.append(job)
+        merged.append(record)
+
+    # Re-merging appends only records the journal does not already hold
+    existing = {Journal.record_key(record): record for record in journal.records()}
+    added = journal.extend([record for record in merged if existing.get(Journal.record_key(record)) != record])
+    if dead_letters is not None:
+        dead_letters.merge(os.path.splitext(shard_path(output_file_path, shard_index, num_shards))[0]
+                           + "_dead_letter.jsonl" for shard_index in range(num_shards))
+        for job in jobs:
+            if journal.is_done(job):
+                dead_letters.resolve(job)
+
+    print(f"🔀 Merged {num_shards} shards into {journal.path}: {len(merged)} jobs ({added} new), "
+          f"{duplicates} duplicates, {len(failed)} failed, {len(missing)} missing of {len(jobs)}")
+    for label, gap in (("Failed", failed), ("Missing", missing)):
+        if gap:
+            listed = ", ".join(f"case {job.case_no} rep {job.repetition}" + (f" ({job.model})" if job.model else "")
+                               for job in gap[:20])
+            print(f"⚠️ {label}: {listed}{' ...' if len(gap) > 20 else ''}")
+    return {"merged": len(merged), "added": added, "duplicates": duplicates, "failed": failed, "missing": missing}
+
+
+def launch(script, num_shards, shard_indices=None, api_keys=(), log_dir="shard_logs"):
+    # Runs the script once per shard as independent worker processes and waits for all of them;
+    # returns {shard index: exit code}. Worker output goes to <log_dir>/<script>_shard<i>of<N>.log.
+    os.makedirs(log_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(script))[0]
+    workers = {}
+    for shard_index in (range(num_shards) if shard_indices is None else shard_indices):
+        env = dict(os.environ, NUM_SHARDS=str(num_shards), SHARD_INDEX=str(shard_index), PYTHONIOENCODING="utf-8")
+        env.pop("MERGE_SHARDS", None)
+        if api_keys:
+            env["SHARD_API_KEY"] = api_keys[shard_index % len(api_keys)]
+        log_path = os.path.join(log_dir, f"{shard_path(stem, shard_index, num_shards)}.log")
+        log = open(log_path, "w", encoding="utf-8")
+        workers[shard_index] = (subprocess.Popen([sys.executable, script], env=env, stdout=log,
+                                                 stderr=subprocess.STDOUT), log, log_path)
+        print(f"🧵 Shard {shard_index + 1}/{num_shards}: pid {workers[shard_index][0].pid}, log {log_path}")
+
+    exit_codes = {}
+    for shard_index, (process, log, log_path) in workers.items():
+        exit_code = exit_codes[shard_index] = process.wait()
+        log.close()
+        status = "done" if exit_code == 0 else f"failed (exit code {exit_code}, see {log_path})"
+        print(f"🧵 Shard {shard_index + 1}/{num_shards} {status}")
+    return exit_codes
+
+
+def merge(script, num_shards):
+    env = dict(os.environ, NUM_SHARDS=str(num_shards), MERGE_SHARDS="1")
+    return subprocess.run([sys.executable, script], env=env).returncode
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a condition script as sharded worker processes")
+    parser.add_argument("script", help="condition script, e.g. PI+Text.py")
+    parser.add_argument("--shards", type=int, required=True, help="total number of shards across all machines")
+    parser.add_argument("--only", type=int, nargs="*", help="0-based shard indices to run on this machine")
+    parser.add_argument("--log-dir", default="shard_logs")
+    parser.add_argument("--no-merge", action="store_true", help="leave merging to a later run")
+    args = parser.parse_args()
+
+    api_keys = [key.strip() for key in os.environ.get("SHARD_API_KEYS", "").split(",") if key.strip()]
+    exit_codes = launch(args.script, args.shards, args.only, api_keys, args.log_dir)
+    merge_code = 0
+    if not args.no_merge:
+        # Merging with shards still missing reports their jobs as missing
+        merge_code = merge(args.script, args.shards)
+    sys.exit(1 if merge_code or any(exit_codes.values()) else 0)
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from pipeline.journal import journal_frame, journal_path
+from pipeline.output import write_excel
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Compact result store for analysing many runs. An output table is kept as a directory
+# <output>.results holding:
+# - core.arrow: an uncompressed Arrow IPC file with the short columns (case numbers, ranks,
+#   diagnoses, repetition). Text columns are dictionary-encoded, so a diagnosis repeated across
+#   thousands of rows is stored once, and they load as pandas categoricals. The file is
+#   memory-mapped, so only the pages of the columns a frame asks for are read.
+# - text.parquet: the long free text (Reason, Features, Image Findings), zstd-compressed and read
+#   only when a frame asks for those columns.
+# - store.json: column layout, including the columns and order of the Excel export.
+# Columns mixing value types (e.g. numeric ranks and "Error") are stored as JSON text and decoded
+# on load, so export_excel writes the same cells as the Excel export.
+# Convert: python -m pipeline.store build PI+Text_output.xlsx [PI+Text_output.results]
+#          (repetitions are taken from the workbook's journal when it is alongside)
+# Export:  python -m pipeline.store export PI+Text_output.results PI+Text_output.xlsx
+
+# Text columns longer than this on average go to the compressed text file
+TEXT_MIN_LENGTH = 64
+_CORE = "core.arrow"
+_TEXT = "text.parquet"
+_LAYOUT = "store.json"
+
+
+def _missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def _is_mixed(values):
+    types = values[values.map(lambda value: not _missing(value))].map(type)
+    return types.nunique() > 1 or not types.isin([str, int, float, bool]).all()
+
+
+def write_result_store(path, df, excel_columns=None, text_columns=None):
+    # text_columns defaults to the text columns whose values average over TEXT_MIN_LENGTH characters
+    excel_columns = list(df.columns if excel_columns is None else excel_columns)
+    object_columns = [column for column in df.columns if not pd.api.types.is_numeric_dtype(df[column])]
+    if text_columns is None:
+        text_columns = [
+            column for column in object_columns
+            if df[column].map(lambda value: len(value) if isinstance(value, str) else 0).mean() > TEXT_MIN_LENGTH
+        ]
+    json_columns = []
+    core, text = {}, {}
+    for column in df.columns:
+        if column not in object_columns:
+            core[column] = pa.array(df[column])
+            continue
+        values = [None if _missing(value) else value for value in df[column]]
+        if _is_mixed(df[column]):
+            values = [None if value is None else json.dumps(value, default=str) for value in values]
+            json_columns.append(column)
+        if column in text_columns:
+            text[column] = pa.array(values, type=pa.string())
+        elif all(value is None or isinstance(value, str) for value in values):
+            core[column] = pa.array(values, type=pa.string()).dictionary_encode()
+        else:
+            # Numbers held as objects (e.g. case numbers) keep their type
+            core[column] = pa.array(values)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    with pa.OSFile(os.path.join(tmp_path, _CORE), "wb") as sink:
+        core_table = pa.table(core) if core else pa.table({"_rows": pa.nulls(len(df), pa.int8())})
+        with pa.ipc.new_file(sink, core_table.schema) as writer:
+            writer.write_table(core_table)
+    if text:
+        pq.write_table(pa.table(text), os.path.join(tmp_path, _TEXT), compression="zstd")
+    with open(os.path.join(tmp_path, _LAYOUT), "w", encoding="utf-8") as f:
+        json.dump({"rows": len(df), "columns": list(df.columns), "excel_columns": excel_columns,
+                   "text_columns": list(text), "json_columns": json_columns}, f, ensure_ascii=False, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def export_result_store(outputs, table, path, model=None):
+    # A table of a pipeline.output.PartitionedOutput as a result store, with each row's repetition
+    write_result_store(path, outputs.frame(table, model, repetition=True), outputs.tables[table])
+
+
+def is_result_store(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, _LAYOUT))
+
+
+class ResultStore:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _LAYOUT), "r", encoding="utf-8") as f:
+            layout = json.load(f)
+        self.rows = layout["rows"]
+        self.columns = layout["columns"]
+        self.excel_columns = layout["excel_columns"]
+        self.text_columns = layout["text_columns"]
+        self.json_columns = layout["json_columns"]
+
+    def _decode(self, df, column):
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Only the distinct values need decoding
+            df[column] = values.cat.rename_categories([json.loads(value) for value in values.cat.categories])
+        else:
+            df[column] = values.map(lambda value: None if value is None else json.loads(value)).astype(object)
+
+    def frame(self, columns=None):
+        # The requested columns; short text columns come back as categoricals
+        columns = list(self.columns if columns is None else columns)
+        missing = [column for column in columns if column not in self.columns]
+        if missing:
+            raise KeyError(f"{self.path} has no column(s) {missing}")
+        core_columns = [column for column in columns if column not in self.text_columns]
+        text_columns = [column for column in columns if column in self.text_columns]
+
+        df = pd.DataFrame(index=pd.RangeIndex(self.rows))
+        if core_columns:
+            # The mapping stays open for as long as the frame's buffers refer to it
+            table = pa.ipc.open_file(pa.memory_map(os.path.join(self.path, _CORE), "r")).read_all()
+            df = table.select(core_columns).to_pandas()
+        if text_columns:
+            text_df = pq.read_table(os.path.join(self.path, _TEXT), columns=text_columns).to_pandas()
+            df = pd.concat([df, text_df], axis=1) if core_columns else text_df
+        for column in columns:
+            if column in self.json_columns:
+                self._decode(df, column)
+        return df[columns]
+
+    def export_excel(self, path):
+        # The workbook shape of the output table, cell for cell
+        df = self.frame(self.excel_columns)
+        for column in df.columns:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(object)
+        write_excel(path, df, self.excel_columns)
+
+    def memory_usage(self, columns=None):
+        return int(self.frame(columns).memory_usage(deep=True).sum())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert output workbooks to compact result stores and back")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="output workbook -> result store")
+    build_parser.add_argument("workbook")
+    build_parser.add_argument("store", nargs="?", help="defaults to <workbook>.results")
+    export_parser = commands.add_parser("export", help="result store -> output workbook")
+    export_parser.add_argument("store")
+    export_parser.add_argument("workbook")
+    args = parser.parse_args()
+
+    if pa is None:
+        parser.error("the result store needs pyarrow")
+    if args.command == "build":
+        store_path = args.store or os.path.splitext(args.workbook)[0] + ".results"
+        df = pd.read_excel(args.workbook)
+        if os.path.exists(journal_path(args.workbook)):
+            # The journal the workbook was exported from also records each row's repetition
+            columns = list(df.columns)
+            df = journal_frame(journal_path(args.workbook)).reindex(columns=columns + ["Repetition"])
+            write_result_store(store_path, df, columns)
+        else:
+            print(f"⚠️ No {journal_path(args.workbook)}: the store has no Repetition column to score by")
+            write_result_store(store_path, df)
+        store = ResultStore(store_path)
+        print(f"🗂️ {args.workbook} -> {store_path}: {store.rows:,} rows, "
+              f"{store.memory_usage() / 1e6:.1f} MB in memory when fully loaded")
+    else:
+        ResultStore(args.store).export_excel(args.workbook)
@@ -0,0 +1,185 @@
+import re
+import time
+import types
+
+# Streaming mode: the response is read token by token, the JSON object is scanned as it
+# arrives, and the stream is dropped as soon as it can no longer produce a usable
+# differential_diagnoses array, instead of paying for the rest of the completion.
+
+EXPECTED_KEYS = {"differential_diagnoses", "image_findings"}
+REFUSAL_PATTERN = re.compile(
+    r"\b(i'?m sorry|i am sorry|i can'?t|i cannot|i'?m unable|i am unable|unable to (provide|assist|help)|as an ai)\b"
+)
+# Default for the text the model may put before the object without it being a problem (```json
+# fences, a hedge such as "I can't be certain, but..." or a short explanation); None removes the limit
+MAX_PREAMBLE_CHARS = 300
+
+
+class StreamAborted(ValueError):
+    # A ValueError, so the rate limiter treats it like any other unusable output (resample)
+    pass
+
+
+class EarlyAbortScanner:
+    # Incremental scanner over the text of one choice. It tracks string/escape state and
+    # nesting depth, collects the top-level keys and raises StreamAborted when no object starts
+    # within max_preamble characters, a top-level key is unexpected, differential_diagnoses is not
+    # an array, or the object closes without it. Refusal wording in the preamble alone does not
+    # abort: an answer may open with a hedge and still bring its diagnosis list.
+
+    def __init__(self, expected_keys=EXPECTED_KEYS, max_preamble=MAX_PREAMBLE_CHARS):
+        self.expected_keys = expected_keys
+        self.max_preamble = max_preamble
+        self.preamble = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.key_chars = None
+        self.last_key = None
+        self.keys = []
+        self.expect_array = False
+        self.closed = False
+
+    def feed(self, text):
+        if self.closed:
+            return
+        for ch in text:
+            self._step(ch)
+            if self.closed:
+                break
+        if self.depth == 0 and not self.closed and self.max_preamble is not None:
+            preamble = "".join(self.preamble).strip()
+            if len(preamble) > self.max_preamble:
+                if REFUSAL_PATTERN.search(preamble.lower()):
+                    raise StreamAborted(f"Refusal without a JSON object: {preamble[:80]!r}")
+                raise StreamAborted("No JSON object within the first "
+                                    f"{self.max_preamble} characters of the response.")
+
+    def _step(self, ch):
+        if self.depth == 0:
+            if ch == "{":
+                self.depth = 1
+                self.expect_key = True
+            else:
+                self.preamble.append(ch)
+            return
+
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif ch == "\\":
+                self.escape = True
+            elif ch == '"':
+                self.in_string = False
+                if self.key_chars is not None:
+                    self._key_done("".join(self.key_chars))
+                    self.key_chars = None
+            elif self.key_chars is not None:
+                self.key_chars.append(ch)
+            return
+
+        if self.expect_array and not ch.isspace():
+            self.expect_array = False
+            if ch != "[":
+                raise StreamAborted("'differential_diagnoses' is not an array.")
+
+        if ch == '"':
+            self.in_string = True
+            if self.depth == 1 and self.expect_key:
+                self.key_chars = []
+        elif ch in "{[":
+            self.depth += 1
+        elif ch in "}]":
+            self.depth -= 1
+            if self.depth == 0:
+                self.closed = True
+                if "differential_diagnoses" not in self.keys:
+                    raise StreamAborted("Invalid JSON structure: 'differential_diagnoses' not found.")
+        elif self.depth == 1 and ch == ",":
+            self.expect_key = True
+        elif self.depth == 1 and ch == ":":
+            self.expect_key = False
+            self.expect_array = self.last_key == "differential_diagnoses"
+
+    def _key_done(self, key):
+        self.last_key = key
+        self.keys.append(key)
+        if key not in self.expected_keys:
+            raise StreamAborted(f"Unexpected top-level key {key!r} in the response.")
+
+
+class StreamMonitor:
+    # Collects streamed chunks into a response object shaped like a non-streamed one, records
+    # time to first token and counts early aborts. Early aborts are only applied to
+    # single-choice requests; with n > 1 a bad choice must not cancel the good ones.
+
+    def __init__(self, max_preamble=MAX_PREAMBLE_CHARS):
+        self.max_preamble = max_preamble
+        self.ttft = []
+        self.streams = 0
+        self.aborts = 0
+        self.aborted_chars = 0
+
+    def start(self):
+        return {"started": time.perf_counter(), "first": None, "parts": {}, "usage": None, "scanner": None}
+
+    def _on_chunk(self, state, chunk):
+        if getattr(chunk, "usage", None) is not None:
+            state["usage"] = chunk.usage
+        for choice in chunk.choices:
+            delta = choice.delta.content or ""
+            if not delta:
+                continue
+            if state["first"] is None:
+                state["first"] = time.perf_counter()
+                self.ttft.append(state["first"] - state["started"])
+            state["parts"].setdefault(choice.index, []).append(delta)
+            if choice.index == 0 and state["scanner"] is not None:
+                state["scanner"].feed(delta)
+
+    def _response(self, state):
+        choices = [
+            types.SimpleNamespace(index=index, message=types.SimpleNamespace(content="".join(parts)))
+            for index, parts in sorted(state["parts"].items())
+        ]
+        return types.SimpleNamespace(choices=choices, usage=state["usage"])
+
+    def _aborted(self, state):
+        self.aborts += 1
+        self.aborted_chars += sum(len(part) for part in state["parts"].get(0, []))
+
+    def collect(self, stream, request):
+        state = self.start()
+        state["scanner"] = EarlyAbortScanner(max_preamble=self.max_preamble) if request.get("n", 1) == 1 else None
+        self.streams += 1
+        try:
+            for chunk in stream:
+                self._on_chunk(state, chunk)
+        except StreamAborted:
+            self._aborted(state)
+            stream.close()
+            raise
+        return self._response(state)
+
+    async def collect_async(self, stream, request):
+        state = self.start()
+        state["scanner"] = EarlyAbortScanner(max_preamble=self.max_preamble) if request.get("n", 1) == 1 else None
+        self.streams += 1
+        try:
+            async for chunk in stream:
+                self._on_chunk(state, chunk)
+        except StreamAborted:
+            self._aborted(state)
+            await stream.close()
+            raise
+        return self._response(state)
+
+    def stats(self):
+        ttft = sorted(self.ttft)
+        return {
+            "streams": self.streams,
+            "ttft_p50_s": ttft[len(ttft) // 2] if ttft else None,
+            "early_aborts": self.aborts,
+            "aborted_chars": self.aborted_chars,
+        }